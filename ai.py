@@ -1,12 +1,1608 @@
-import requests
 import json
 import argparse
 import time
 import os
 import re
-import subprocess
+import sys
+import threading
+import hashlib
+from collections import Counter
+from itertools import chain
+import heapq
+import math
+import random
 from datetime import datetime
-from dotenv import load_dotenv, set_key
+
+
+API_URL = "https://api.together.xyz/v1/chat/completions"
+
+MODELS = [
+    ("DeepSeek R1 Distill", "deepseek-ai/DeepSeek-R1-Distill-Llama-70B"),
+    ("DeepSeek R1 ", "deepseek-ai/DeepSeek-R1-0528"),
+    ("Llama 3.3", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"),
+    ("AFM 4.5B", "arcee-ai/AFM-4.5B-Preview"),
+    ("EXAONE 3.5 32B", "lgai/exaone-3-5-32b-instruct"),
+    ("EXAONE Deep 32B", "lgai/exaone-deep-32b")
+]
+DEFAULT_MODEL = MODELS[0][1]
+AUTO_MODEL = "auto"
+
+MODEL_TIERS = {
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-70B": 2,
+    "deepseek-ai/DeepSeek-R1-0528": 3,
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free": 2,
+    "arcee-ai/AFM-4.5B-Preview": 1,
+    "lgai/exaone-3-5-32b-instruct": 1,
+    "lgai/exaone-deep-32b": 2
+}
+
+LAZY_MODULES = ["requests", "dotenv", "subprocess", "concurrent.futures", "email.utils", "asyncio", "socketserver"]
+
+DAEMON_SOCKET = os.path.join("workspace", ".clia", "daemon.sock")
+
+RUN_WORKER = r"""
+import json, os, runpy, signal, sys
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+with os.fdopen(int(sys.argv[1]), "r") as control:
+    request = json.loads(control.readline() or "null")
+if request is None:
+    sys.exit(0)
+try:
+    import resource
+    if request["memory"]:
+        resource.setrlimit(resource.RLIMIT_AS, (request["memory"], request["memory"]))
+    if request["cpu"]:
+        resource.setrlimit(resource.RLIMIT_CPU, (request["cpu"], request["cpu"] + 1))
+except (ImportError, ValueError, OSError):
+    pass
+signal.signal(signal.SIGINT, signal.default_int_handler)
+sys.argv = [request["path"]]
+sys.path[0] = os.path.dirname(os.path.abspath(request["path"]))
+try:
+    runpy.run_path(request["path"], run_name="__main__")
+except SystemExit:
+    raise
+except BaseException as error:
+    import traceback
+    tb = error.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != request["path"]:
+        tb = tb.tb_next
+    traceback.print_exception(type(error), error, tb or error.__traceback__)
+    sys.exit(1)
+"""
+
+MODEL_CONTEXT = {
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-70B": 8192,
+    "deepseek-ai/DeepSeek-R1-0528": 163840,
+    "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free": 8192,
+    "arcee-ai/AFM-4.5B-Preview": 4096,
+    "lgai/exaone-3-5-32b-instruct": 32768,
+    "lgai/exaone-deep-32b": 32768
+}
+DEFAULT_CONTEXT = 8192
+CACHE_MAX_TEMPERATURE = 0.3
+OUTPUT_BUDGETS = {"short": 512, "chat": 1024, "code": 2048, "file": 4096}
+MIN_OUTPUT_TOKENS = 256
+REASONING_MODELS = {"deepseek-ai/DeepSeek-R1-Distill-Llama-70B", "deepseek-ai/DeepSeek-R1-0528", "lgai/exaone-deep-32b"}
+CODE_REQUEST = re.compile(r"```|\b(write|implement|code|script|function|class|program|refactor|generate|fix)\b", re.I)
+LONG_REQUEST = re.compile(r"\b(explain|describe|detail\w*|compare|summar\w*|list|steps|why|how)\b", re.I)
+CONTINUE_PROMPT = ("Continue exactly where your previous reply stopped, mid-word if necessary. "
+                   "Do not repeat anything, do not reopen code blocks, and add no commentary.")
+PAGE_THRESHOLD = 1024 * 1024
+PAGE_LINES = 200
+MAX_LINE_BYTES = 64 * 1024
+
+FILE_RULES = """IMPORTANT RULES:
+- Output ONLY executable code, no explanations, comments, or markdown
+- Do NOT include ```python, ```html, or any code block markers
+- Do NOT include file paths or comments like "// filepath:"
+- Do NOT add explanatory text before or after the code
+- Generate clean, working code that can be saved and run directly
+- If it's a Python file, start directly with imports or code
+- If it's HTML, start directly with <!DOCTYPE html>
+- If it's CSS, start directly with selectors"""
+
+
+class APIError(Exception):
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"{status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status_code, response.text, cls.parse_retry_after(response.headers.get("Retry-After")))
+
+    @staticmethod
+    def parse_retry_after(value):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class StreamInterrupted(Exception):
+    pass
+
+
+class TurnCancelled(Exception):
+    pass
+
+
+class ChatJob:
+    def __init__(self, job_id, prompt):
+        self.id = job_id
+        self.prompt = prompt
+        self.cancel = threading.Event()
+        self.started = None
+        self.done = None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ModelRouter:
+    def __init__(self, path, alpha=0.3, explore=0.1, save_interval=5.0):
+        self.path = path
+        self.alpha = alpha
+        self.explore = explore
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.stats = json.load(f).get("models", {})
+        except (OSError, ValueError):
+            self.stats = {}
+
+    def observe(self, model, latency, ok):
+        with self.lock:
+            entry = self.stats.get(model)
+            if entry is None:
+                entry = self.stats[model] = {"latency": None, "error_rate": 0.0 if ok else 1.0, "samples": 0}
+            else:
+                entry["error_rate"] += self.alpha * ((0.0 if ok else 1.0) - entry["error_rate"])
+            if ok:
+                previous = entry["latency"]
+                entry["latency"] = latency if previous is None else previous + self.alpha * (latency - previous)
+            entry["samples"] += 1
+            entry["updated"] = time.time()
+            self.dirty = True
+            due = time.monotonic() - self.saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def score(self, model):
+        entry = self.stats.get(model)
+        if entry is None:
+            return None
+        if entry["latency"] is None:
+            return float("inf")
+        return entry["latency"] / max(1.0 - entry["error_rate"], 0.05)
+
+    def rank(self, models):
+        return sorted(models, key=lambda model: (self.score(model) is not None, self.score(model) or 0.0))
+
+    def choose(self, models):
+        unseen = [model for model in models if model not in self.stats]
+        if unseen:
+            return unseen[0]
+        if random.random() < self.explore:
+            return random.choice(models)
+        return min(models, key=self.score)
+
+    def describe(self, model):
+        entry = self.stats.get(model)
+        if entry is None:
+            return "no data"
+        latency = f"{entry['latency']:.2f}s" if entry["latency"] is not None else "-"
+        return f"{latency} ewma, {entry['error_rate']:.0%} errors, {entry['samples']} samples"
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({"models": self.stats}, indent=2)
+            self.dirty = False
+            self.saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+_phase_timings = threading.local()
+_timed_pool_classes = {}
+_turn_state = threading.local()
+
+
+def check_cancelled():
+    cancel = getattr(_turn_state, "cancel", None)
+    if cancel is not None and cancel.is_set():
+        raise TurnCancelled("turn cancelled")
+
+
+def cancellable_sleep(delay):
+    cancel = getattr(_turn_state, "cancel", None)
+    if cancel is None:
+        time.sleep(delay)
+    elif cancel.wait(delay):
+        raise TurnCancelled("turn cancelled")
+
+
+def wait_cancellable(futures, return_when="ALL_COMPLETED"):
+    from concurrent.futures import wait, FIRST_COMPLETED
+    done, pending = set(), set(futures)
+    while pending:
+        finished, pending = wait(pending, timeout=0.1, return_when=return_when)
+        done |= finished
+        if finished and return_when == FIRST_COMPLETED:
+            break
+        check_cancelled()
+    return done, pending
+
+
+def run_detached(function, *args):
+    from concurrent.futures import Future
+    future = Future()
+
+    def target():
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def as_completed_cancellable(futures):
+    pending = set(futures)
+    while pending:
+        done, pending = wait_cancellable(pending, "FIRST_COMPLETED")
+        yield from done
+
+
+def phase_timings():
+    timings = getattr(_phase_timings, "timings", None)
+    if timings is None:
+        timings = _phase_timings.timings = {}
+    return timings
+
+
+def timed_pool_classes():
+    if _timed_pool_classes:
+        return _timed_pool_classes
+    from urllib3 import connection, connectionpool
+
+    class TimedConnectionMixin:
+        def _new_conn(self):
+            start = time.perf_counter()
+            sock = super()._new_conn()
+            phase_timings()["connect"] = time.perf_counter() - start
+            return sock
+
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            timings = phase_timings()
+            if isinstance(self, connection.HTTPSConnection):
+                elapsed = time.perf_counter() - start
+                timings["tls"] = max(0.0, elapsed - timings.get("connect", 0.0))
+
+    class TimedHTTPConnection(TimedConnectionMixin, connection.HTTPConnection):
+        pass
+
+    class TimedHTTPSConnection(TimedConnectionMixin, connection.HTTPSConnection):
+        pass
+
+    class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    _timed_pool_classes.update({"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool})
+    return _timed_pool_classes
+
+
+class HTTPClient:
+    def __init__(self, pool_size=10, connect_timeout=10.0, read_timeout=300.0):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.api_key = None
+        self.requests_sent = 0
+        self.lock = threading.Lock()
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.adapter.poolmanager.pool_classes_by_scheme = dict(timed_pool_classes())
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def authorize(self, api_key):
+        if api_key != self.api_key:
+            self.api_key = api_key
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def post(self, url, payload, stream=False):
+        with self.lock:
+            self.requests_sent += 1
+        body = json.dumps(payload).encode('utf-8')
+        timings = phase_timings()
+        timings.clear()
+        response = self.session.post(url, data=body, stream=stream, timeout=self.timeout)
+        response.timings = {
+            "connect": timings.get("connect", 0.0),
+            "tls": timings.get("tls", 0.0),
+            "ttfb": response.elapsed.total_seconds(),
+            "reused": "connect" not in timings,
+            "request_bytes": len(body)
+        }
+        return response
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        requests_made = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return {
+            "requests": self.requests_sent,
+            "connections": connections,
+            "reused": max(0, requests_made - connections),
+            "pool_size": self.pool_size
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class MetricsRecorder:
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+    def __init__(self, path=None, max_samples=10000):
+        self.path = path
+        self.max_samples = max_samples
+        self.records = []
+        self.latencies = {}
+        self.buckets = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @property
+    def prometheus(self):
+        return bool(self.path) and self.path.endswith((".prom", ".txt"))
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if len(self.records) > self.max_samples:
+                del self.records[0]
+            model = record["model"]
+            samples = self.latencies.setdefault(model, [])
+            samples.append(record["total"])
+            if len(samples) > self.max_samples:
+                del samples[0]
+            counts = self.buckets.setdefault(model, [0] * (len(self.BUCKETS) + 1))
+            counts[next((i for i, bound in enumerate(self.BUCKETS) if record["total"] <= bound),
+                        len(self.BUCKETS))] += 1
+            totals = self.totals.setdefault(model, {
+                "count": 0, "seconds": 0.0, "request_bytes": 0, "response_bytes": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "status": {}
+            })
+            totals["count"] += 1
+            totals["seconds"] += record["total"]
+            totals["request_bytes"] += record["request_bytes"]
+            totals["response_bytes"] += record["response_bytes"]
+            totals["prompt_tokens"] += record["prompt_tokens"] or 0
+            totals["completion_tokens"] += record["completion_tokens"] or 0
+            status = str(record["status"])
+            totals["status"][status] = totals["status"].get(status, 0) + 1
+            if self.path and not self.prometheus:
+                try:
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
+
+    def summary(self):
+        with self.lock:
+            return {model: (len(samples), percentile(samples, 0.5), percentile(samples, 0.95),
+                            percentile(samples, 0.99))
+                    for model, samples in self.latencies.items()}
+
+    def write_prometheus(self):
+        lines = [
+            "# HELP clia_request_duration_seconds Chat-completion request latency.",
+            "# TYPE clia_request_duration_seconds histogram"
+        ]
+        with self.lock:
+            for model, counts in self.buckets.items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f'clia_request_duration_seconds_bucket{{model="{model}",le="{bound}"}} {cumulative}')
+                lines.append(f'clia_request_duration_seconds_sum{{model="{model}"}} {self.totals[model]["seconds"]}')
+                lines.append(f'clia_request_duration_seconds_count{{model="{model}"}} {cumulative}')
+            lines.append("# TYPE clia_requests_total counter")
+            for model, totals in self.totals.items():
+                for status, count in totals["status"].items():
+                    lines.append(f'clia_requests_total{{model="{model}",status="{status}"}} {count}')
+            lines.append("# TYPE clia_bytes_total counter")
+            for model, totals in self.totals.items():
+                lines.append(f'clia_bytes_total{{model="{model}",direction="sent"}} {totals["request_bytes"]}')
+                lines.append(f'clia_bytes_total{{model="{model}",direction="received"}} {totals["response_bytes"]}')
+            lines.append("# TYPE clia_tokens_total counter")
+            for model, totals in self.totals.items():
+                lines.append(f'clia_tokens_total{{model="{model}",kind="prompt"}} {totals["prompt_tokens"]}')
+                lines.append(f'clia_tokens_total{{model="{model}",kind="completion"}} {totals["completion_tokens"]}')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+
+    def close(self):
+        if self.prometheus and self.records:
+            try:
+                self.write_prometheus()
+            except OSError as e:
+                print(f"Could not write metrics: {e}")
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    ORPHAN_GRACE = 60.0
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+        self.index = self._load_index()
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens):
+        material = json.dumps([model, messages, temperature, max_tokens],
+                              sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(index))
+        os.replace(tmp_path, self.index_path)
+
+    def _transact(self, update):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            index = self._load_index()
+            for key, used in self.touched.items():
+                if key in index:
+                    index[key]["used"] = max(index[key]["used"], used)
+            self.touched = {}
+            update(index)
+            self._save_index(index)
+            self.index = index
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _remove(self, index, key):
+        index.pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None and os.path.exists(self._entry_path(key)):
+                self.index = self._load_index()
+                entry = self.index.get(key)
+            now = time.time()
+            if entry is None or now - entry["created"] > self.ttl:
+                if entry is not None:
+                    self._transact(lambda index: self._remove(index, key))
+                self.misses += 1
+                return None
+            try:
+                with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except OSError:
+                self._transact(lambda index: self._remove(index, key))
+                self.misses += 1
+                return None
+            entry["used"] = self.touched[key] = now
+            self.hits += 1
+            self.bytes_saved += entry["size"]
+            return content
+
+    def put(self, key, content):
+        data = content.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._entry_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._entry_path(key))
+            now = time.time()
+
+            def update(index):
+                index[key] = {"size": len(data), "created": now, "used": now}
+                self._evict(index, now)
+
+            self._transact(update)
+
+    def flush(self):
+        with self.lock:
+            if self.touched:
+                self._transact(lambda index: None)
+
+    def _evict(self, index, now):
+        for key in [k for k, entry in index.items() if now - entry["created"] > self.ttl]:
+            self._remove(index, key)
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]["size"]
+            self._remove(index, key)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.split(".")[0] in index or name in ("index.json", "index.lock"):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.ORPHAN_GRACE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def size(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+
+class RateLimiter:
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, key):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(key, now))
+            self.next_slot[key] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SharedRateLimiter:
+    KINDS = ("requests", "tokens")
+    HEADERS = {
+        "requests": ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests", "x-ratelimit-reset-requests",
+                     "x-ratelimit-limit", "x-ratelimit-remaining", "x-ratelimit-reset"),
+        "tokens": ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens")
+    }
+
+    def __init__(self, path, requests_per_minute=0, tokens_per_minute=0, max_wait=5.0, stale_after=600.0):
+        self.path = path
+        self.stale_after = stale_after
+        self.configured = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.waited = 0.0
+        self.limits = {}
+
+    @staticmethod
+    def parse_reset(value):
+        try:
+            seconds = float(value)
+            return max(0.0, seconds - time.time()) if seconds > 1e9 else seconds
+        except (TypeError, ValueError):
+            pass
+        units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+        parts = re.findall(r"([\d.]+)(ms|s|m|h)", str(value or ""))
+        return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+    def _transact(self, update):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+", encoding="utf-8") as f:
+                try:
+                    import fcntl
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                except ImportError:
+                    pass
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                now = time.time()
+                self._refill(state, now)
+                result = update(state, now)
+                self.limits = dict(state.get("limits", {}))
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                return result
+
+    def limit(self, state, kind):
+        return self.configured[kind] or state.get("limits", {}).get(kind, 0)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state.get("updated", now))
+        for kind in self.KINDS:
+            limit = self.limit(state, kind)
+            if limit:
+                state[kind] = min(limit, state.get(kind, limit) + elapsed * limit / 60.0)
+        state["updated"] = now
+        state["inflight"] = [started for started in state.get("inflight", []) if started > now - self.stale_after]
+
+    def acquire(self, tokens):
+        def take(state, now):
+            wait = max(0.0, state.get("blocked_until", 0.0) - now)
+            amounts = {"requests": 1, "tokens": tokens}
+            for kind in self.KINDS:
+                limit = self.limit(state, kind)
+                if limit:
+                    amounts[kind] = min(amounts[kind], limit)
+                    if state[kind] < amounts[kind]:
+                        wait = max(wait, (amounts[kind] - state[kind]) * 60.0 / limit)
+            if wait <= 0:
+                for kind in self.KINDS:
+                    if self.limit(state, kind):
+                        state[kind] -= amounts[kind]
+                state["inflight"].append(now)
+            return wait
+
+        started = time.monotonic()
+        queued = False
+        while True:
+            wait = self._transact(take)
+            if wait <= 0:
+                break
+            queued = True
+            cancellable_sleep(min(wait, self.max_wait))
+        if queued:
+            with self.lock:
+                self.waits += 1
+                self.waited += time.monotonic() - started
+
+    def settle(self, headers, reserved, used=None, retry_after=None):
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+
+        def update(state, now):
+            if state["inflight"]:
+                state["inflight"].remove(min(state["inflight"]))
+            unseen = len(state["inflight"])
+            limits = state.setdefault("limits", {})
+            for kind, names in self.HEADERS.items():
+                for limit_name, remaining_name, reset_name in zip(names[::3], names[1::3], names[2::3]):
+                    try:
+                        limit = float(headers[limit_name])
+                    except (KeyError, ValueError):
+                        continue
+                    if limit > 0:
+                        limits[kind] = limit
+                        state[kind] = min(state.get(kind, limit), limit)
+                    try:
+                        remaining = float(headers[remaining_name])
+                    except (KeyError, ValueError):
+                        break
+                    remaining -= unseen if kind == "requests" else 0
+                    state[kind] = min(state[kind], remaining) if kind in state else remaining
+                    reset = self.parse_reset(headers.get(reset_name))
+                    if remaining <= 0 and reset:
+                        state["blocked_until"] = max(state.get("blocked_until", 0.0), now + reset)
+                    break
+            if used is not None and "tokens" in state:
+                state["tokens"] = min(self.limit(state, "tokens") or state["tokens"],
+                                      state["tokens"] + max(0, reserved - used))
+            if retry_after is not None:
+                state["blocked_until"] = max(state.get("blocked_until", 0.0), now + retry_after)
+                if "requests" in state:
+                    state["requests"] = 0.0
+
+        self._transact(update)
+
+    def describe(self):
+        parts = []
+        for kind in self.KINDS:
+            limit = self.configured[kind] or self.limits.get(kind)
+            if limit:
+                source = "set" if self.configured[kind] else "learned"
+                parts.append(f"{limit:g} {kind}/min ({source})")
+        return ", ".join(parts)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def iter_line_chunks(path, max_bytes, max_line=MAX_LINE_BYTES):
+    with open(path, 'rb') as f:
+        lines = []
+        size = 0
+        line_number = 0
+        start_line = 1
+        while True:
+            line = f.readline(min(max_line, max_bytes))
+            if not line:
+                break
+            if lines and size + len(line) > max_bytes:
+                end_line = line_number if lines[-1].endswith(b"\n") else line_number + 1
+                yield start_line, end_line, b"".join(lines).decode('utf-8', errors='replace'), f.tell() - len(line)
+                lines, size, start_line = [], 0, line_number + 1
+            lines.append(line)
+            size += len(line)
+            if line.endswith(b"\n"):
+                line_number += 1
+        if lines:
+            end_line = line_number if lines[-1].endswith(b"\n") else line_number + 1
+            yield start_line, end_line, b"".join(lines).decode('utf-8', errors='replace'), f.tell()
+
+
+class MessageNode:
+    __slots__ = ("role", "content", "parent", "tokens", "total_tokens", "depth")
+
+    def __init__(self, role, content, parent=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.parent = parent
+        self.tokens = Conversation.estimate_tokens(self)
+        self.total_tokens = self.tokens + (parent.total_tokens if parent else 0)
+        self.depth = parent.depth + 1 if parent else 1
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class Conversation:
+    def __init__(self, messages=None, branch="main"):
+        self.branch = branch
+        self.branches = {branch: None}
+        self.path = []
+        for message in messages or []:
+            self.append(message)
+
+    @staticmethod
+    def estimate_tokens(message):
+        return (len(message["content"]) + 3) // 4 + 4
+
+    @property
+    def head(self):
+        return self.path[-1] if self.path else None
+
+    @property
+    def total_tokens(self):
+        return self.path[-1].total_tokens if self.path else 0
+
+    def append(self, message):
+        node = MessageNode(message["role"], message["content"], self.head)
+        self.path.append(node)
+        self.branches[self.branch] = node
+
+    def clear(self):
+        self.branch = "main"
+        self.branches = {"main": None}
+        self.path = []
+
+    def fork(self, name=None):
+        if name is None:
+            number = len(self.branches)
+            while f"branch-{number}" in self.branches:
+                number += 1
+            name = f"branch-{number}"
+        if name in self.branches:
+            raise ValueError(f"Branch {name} already exists")
+        self.branches[name] = self.head
+        self.branch = name
+        return name
+
+    def undo(self):
+        count = 0
+        if self.path and self.path[-1].role == "assistant":
+            count += 1
+        if len(self.path) > count and self.path[-1 - count].role == "user":
+            count += 1
+        count = count or min(1, len(self.path))
+        if count:
+            del self.path[-count:]
+        self.branches[self.branch] = self.head
+        return count
+
+    def checkout(self, name):
+        if name not in self.branches:
+            raise ValueError(f"No branch named {name}")
+        node = self.branches[name]
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        self.branch = name
+        self.path = path
+
+    def shared_depth(self, name):
+        node = self.branches[name]
+        while node is not None and (node.depth > len(self.path) or self.path[node.depth - 1] is not node):
+            node = node.parent
+        return node.depth if node is not None else 0
+
+    def to_list(self):
+        return [node.to_dict() for node in self.path]
+
+    def to_tree(self):
+        index = {}
+        nodes = []
+        for tip in self.branches.values():
+            segment = []
+            node = tip
+            while node is not None and id(node) not in index:
+                segment.append(node)
+                node = node.parent
+            for node in reversed(segment):
+                index[id(node)] = len(nodes)
+                nodes.append([index[id(node.parent)] if node.parent is not None else None, node.role, node.content])
+        return {
+            "nodes": nodes,
+            "branches": {name: index[id(tip)] if tip is not None else None for name, tip in self.branches.items()},
+            "branch": self.branch
+        }
+
+    @classmethod
+    def from_tree(cls, tree):
+        nodes = []
+        for parent, role, content in tree.get("nodes", []):
+            nodes.append(MessageNode(role, content, nodes[parent] if parent is not None else None))
+        conversation = cls()
+        conversation.branches = {name: nodes[position] if position is not None else None
+                                 for name, position in tree.get("branches", {}).items()} or {"main": None}
+        conversation.checkout(tree.get("branch") if tree.get("branch") in conversation.branches
+                              else next(iter(conversation.branches)))
+        return conversation
+
+    @classmethod
+    def load(cls, data):
+        if data.get("tree"):
+            return cls.from_tree(data["tree"])
+        return cls(data.get("conversation", []))
+
+    def __len__(self):
+        return len(self.path)
+
+    def __iter__(self):
+        return (node.to_dict() for node in self.path)
+
+    def __getitem__(self, index):
+        return self.path[index].to_dict()
+
+    def window(self, budget, keep_recent=4, pending=()):
+        pending = list(pending)
+        pending_tokens = [self.estimate_tokens(message) for message in pending]
+        total = self.total_tokens + sum(pending_tokens)
+        if total <= budget:
+            return self.to_list() + pending, total, 0
+
+        entries = self.path + pending
+        tokens = [node.tokens for node in self.path] + pending_tokens
+        count = len(entries)
+        recent_start = max(0, count - keep_recent)
+        keep = [True] * count
+        for i in range(recent_start):
+            if total <= budget:
+                break
+            if entries[i]["role"] != "system":
+                keep[i] = False
+                total -= tokens[i]
+        for i in range(recent_start, count - 1):
+            if total <= budget:
+                break
+            if entries[i]["role"] != "system":
+                keep[i] = False
+                total -= tokens[i]
+
+        selected = [entry.to_dict() if isinstance(entry, MessageNode) else entry
+                    for entry, kept in zip(entries, keep) if kept]
+        return selected, total, count - len(selected)
+
+
+class SessionJournal:
+    def __init__(self, directory, name, fsync_every=8, fsync_interval=2.0):
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self.index_path = os.path.join(directory, f"{name}.idx")
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.base = self._read_index().get("base", 0)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"base": self.base, "size": os.path.getsize(self.path)}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def append(self, record, base=False):
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = open(self.path, 'ab')
+        offset = self.file.tell()
+        self.file.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+        self.file.flush()
+        self.unsynced += 1
+        if base:
+            self.sync()
+            self.base = offset
+            self._write_index()
+        elif self.unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self._write_index()
+            self.file.close()
+            self.file = None
+
+    def _scan_base(self):
+        base = 0
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.startswith((b'{"type": "snapshot"', b'{"type": "clear"')):
+                    base = offset
+                offset += len(line)
+        return base
+
+    def read(self):
+        index = self._read_index()
+        if "base" in index and index.get("size", 0) <= os.path.getsize(self.path):
+            base = index["base"]
+        else:
+            base = self._scan_base()
+        with open(self.path, 'rb') as f:
+            f.seek(base)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def compact(self, snapshot):
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write((json.dumps(snapshot, ensure_ascii=False) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.base = 0
+        self._write_index()
+
+
+class WorkspaceIndex:
+    FORMAT = 3
+    TOKEN_PATTERN = re.compile(r'[a-z_][a-z0-9_]+')
+
+    def __init__(self, root, index_path, chunk_lines=40, max_file_bytes=1024 * 1024, k1=1.5, b=0.75,
+                 save_interval=300.0):
+        self.root = root
+        self.index_path = index_path
+        self.chunk_lines = chunk_lines
+        self.max_file_bytes = max_file_bytes
+        self.k1 = k1
+        self.b = b
+        self.files = {}
+        self.chunks = {}
+        self.postings = {}
+        self.total_length = 0
+        self.next_chunk_id = 0
+        self.dirty = False
+        self.save_interval = save_interval
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("format") != self.FORMAT or data.get("chunk_lines") != self.chunk_lines:
+                return
+            postings = {term: dict(zip(entries[::2], entries[1::2])) for term, entries in data["postings"].items()}
+            terms = {}
+            for term, entries in postings.items():
+                for chunk_id in entries:
+                    terms.setdefault(chunk_id, []).append(term)
+            chunks = {chunk_id: (relpath, start, end, length, tuple(terms.get(chunk_id, ())))
+                      for chunk_id, relpath, start, end, length in data["chunks"]}
+            files = data["files"]
+            total_length = int(data["total_length"])
+            next_chunk_id = int(data["next_chunk_id"])
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            return
+        self.files = files
+        self.chunks = chunks
+        self.postings = postings
+        self.total_length = total_length
+        self.next_chunk_id = next_chunk_id
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        data = json.dumps({
+            "format": self.FORMAT,
+            "chunk_lines": self.chunk_lines,
+            "files": self.files,
+            "chunks": [(chunk_id, *chunk[:4]) for chunk_id, chunk in self.chunks.items()],
+            "postings": {term: list(chain.from_iterable(entries.items())) for term, entries in self.postings.items()},
+            "total_length": self.total_length,
+            "next_chunk_id": self.next_chunk_id
+        }, separators=(',', ':'))
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def _walk(self):
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != '__pycache__']
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    path = os.path.join(directory, filename)
+                    yield os.path.relpath(path, self.root), path
+
+    def _remove_file(self, relpath):
+        for chunk_id in self.files.pop(relpath, {}).get("chunks", []):
+            chunk = self.chunks.pop(chunk_id)
+            self.total_length -= chunk[3]
+            for term in chunk[4]:
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(chunk_id, None)
+                    if not postings:
+                        del self.postings[term]
+        self.dirty = True
+
+    def _index_file(self, relpath, stat, data, digest):
+        self._remove_file(relpath)
+        lines = data.decode('utf-8', errors='ignore').splitlines()
+        chunk_ids = []
+        for start in range(0, len(lines), self.chunk_lines):
+            tokens = self.tokenize('\n'.join(lines[start:start + self.chunk_lines]))
+            if not tokens:
+                continue
+            chunk_id = self.next_chunk_id
+            self.next_chunk_id += 1
+            counts = Counter(tokens)
+            for term, count in counts.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    self.postings[term] = {chunk_id: count}
+                else:
+                    postings[chunk_id] = count
+            end = min(start + self.chunk_lines, len(lines))
+            self.chunks[chunk_id] = (relpath, start, end, len(tokens), tuple(counts))
+            self.total_length += len(tokens)
+            chunk_ids.append(chunk_id)
+        self.files[relpath] = {"mtime": stat.st_mtime, "size": stat.st_size, "hash": digest, "chunks": chunk_ids}
+
+    def refresh(self):
+        with self.lock:
+            seen = set()
+            changed = 0
+            for relpath, path in self._walk():
+                seen.add(relpath)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                known = self.files.get(relpath)
+                if known and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+                    continue
+                if stat.st_size > self.max_file_bytes:
+                    if known:
+                        self._remove_file(relpath)
+                    continue
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError:
+                    continue
+                if b'\0' in data[:1024]:
+                    continue
+                digest = hashlib.sha1(data).hexdigest()
+                if known and known["hash"] == digest:
+                    known["mtime"] = stat.st_mtime
+                    self.dirty = True
+                    continue
+                self._index_file(relpath, stat, data, digest)
+                self.dirty = True
+                changed += 1
+            for relpath in [r for r in self.files if r not in seen]:
+                self._remove_file(relpath)
+                changed += 1
+            if time.monotonic() - self.saved_at >= self.save_interval:
+                self.save()
+            return changed
+
+    def query(self, text, k=3):
+        terms = set(self.tokenize(text))
+        if not terms or not self.chunks:
+            return []
+        count = len(self.chunks)
+        average_length = self.total_length / count
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, frequency in postings.items():
+                length = self.chunks[chunk_id][3]
+                norm = frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / norm
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunks[chunk_id][:3]) for chunk_id, score in best]
+
+    def read_chunk(self, chunk):
+        relpath, start, end = chunk
+        lines = []
+        with open(os.path.join(self.root, relpath), 'r', encoding='utf-8', errors='ignore') as f:
+            for number, line in enumerate(f):
+                if number >= end:
+                    break
+                if number >= start:
+                    lines.append(line.rstrip('\n'))
+        return '\n'.join(lines)
+
+
+class RunEngine:
+    def __init__(self, workers=0, timeout=60.0, memory_limit_mb=512):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024) if memory_limit_mb else 0
+        self.idle = []
+        self.history = []
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def _spawn(self, stdin=None):
+        import subprocess
+        if os.name == 'nt':
+            return None, None
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen([sys.executable, "-u", "-c", RUN_WORKER, str(read_fd)], stdin=stdin,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(read_fd,))
+        except Exception:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        return process, write_fd
+
+    def warm(self):
+        with self.lock:
+            while len(self.idle) < self.workers:
+                process, control = self._spawn()
+                if process is None:
+                    break
+                self.idle.append((process, control))
+
+    def _acquire(self, interactive=True):
+        if not interactive:
+            import subprocess
+            process, control = self._spawn(subprocess.DEVNULL)
+            return process, control, False
+        with self.lock:
+            while self.idle:
+                process, control = self.idle.pop()
+                if process.poll() is None:
+                    return process, control, True
+                os.close(control)
+        process, control = self._spawn()
+        return process, control, False
+
+    @staticmethod
+    def _pump(pipe, target, tail):
+        import codecs
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = pipe.read1(65536)
+            if not data:
+                break
+            text = decoder.decode(data)
+            if target is not None:
+                target.write(text)
+                target.flush()
+            tail.append(text)
+            while len(tail) > 1 and sum(len(part) for part in tail) > 4096:
+                tail.pop(0)
+
+    def run(self, path, timeout=None, echo=True):
+        import subprocess
+        timeout = self.timeout if timeout is None else timeout
+        process, control, warm = self._acquire(echo)
+        start_time = time.monotonic()
+        if process is None:
+            process = subprocess.Popen([sys.executable, "-u", path], stdin=None if echo else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            request = {"path": path, "memory": self.memory_limit, "cpu": int(timeout) + 1 if timeout else 0}
+            os.write(control, (json.dumps(request) + "\n").encode('utf-8'))
+            os.close(control)
+        with self.lock:
+            self.running.add(process)
+
+        stdout_tail, stderr_tail = [], []
+        readers = [
+            threading.Thread(target=self._pump, args=(process.stdout, sys.stdout if echo else None, stdout_tail),
+                             daemon=True),
+            threading.Thread(target=self._pump, args=(process.stderr, sys.stderr if echo else None, stderr_tail),
+                             daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+
+        outcome = {}
+
+        def reap():
+            if hasattr(os, "wait4"):
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                outcome["peak_rss_kb"] = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+            else:
+                process.wait()
+
+        waiter = threading.Thread(target=reap, daemon=True)
+        waiter.start()
+        status = None
+        try:
+            while waiter.is_alive():
+                waiter.join(0.05)
+                check_cancelled()
+                if timeout and waiter.is_alive() and time.monotonic() - start_time > timeout:
+                    status = "timeout"
+                    process.kill()
+                    waiter.join()
+        except (KeyboardInterrupt, TurnCancelled):
+            status = "cancelled"
+            process.kill()
+            waiter.join()
+        finally:
+            with self.lock:
+                self.running.discard(process)
+        for reader in readers:
+            reader.join()
+
+        exit_code = process.returncode
+        if status is None:
+            status = "ok" if exit_code == 0 else "error"
+        record = {
+            "file": path,
+            "status": status,
+            "exit_code": exit_code,
+            "duration": time.monotonic() - start_time,
+            "peak_rss_kb": outcome.get("peak_rss_kb"),
+            "warm": warm,
+            "stderr_tail": ''.join(stderr_tail)[-4096:]
+        }
+        with self.lock:
+            self.history.append(record)
+        if self.workers:
+            self.warm()
+        return record
+
+    def cancel(self):
+        with self.lock:
+            running = [process for process in self.running if process.poll() is None]
+        for process in running:
+            process.kill()
+        return bool(running)
+
+    def shutdown(self):
+        with self.lock:
+            for process, control in self.idle:
+                os.close(control)
+                try:
+                    process.wait(timeout=1)
+                except Exception:
+                    process.kill()
+            self.idle = []
+
+
+class ThinkingFilter:
+    OPEN_TAGS = ('<think>', '<thought>')
+    CLOSE_TAGS = ('</think>', '</thought>')
+    LONGEST_TAG = len('</thought>')
+
+    def __init__(self, started=False):
+        self.buffer = ""
+        self.closing = None
+        self.started = started
+
+    def feed(self, chunk):
+        buffer = self.buffer + chunk
+        length = len(buffer)
+        position = 0
+        output = []
+        while position < length:
+            if self.closing:
+                end = self._find_close(buffer, position)
+                if end == -1:
+                    position = max(position, length - (len(self.closing) - 1))
+                    break
+                position = end + len(self.closing)
+                self.closing = None
+                continue
+
+            start = buffer.find('<', position)
+            if start == -1:
+                output.append(buffer[position:])
+                position = length
+                break
+            output.append(buffer[position:start])
+            position = start
+
+            head = buffer[position:position + self.LONGEST_TAG].lower()
+            tag = next((t for t in self.OPEN_TAGS + self.CLOSE_TAGS if head.startswith(t)), None)
+            if tag:
+                position += len(tag)
+                if tag in self.OPEN_TAGS:
+                    self.closing = '</' + tag[1:]
+                continue
+            if len(head) < self.LONGEST_TAG and any(t.startswith(head) for t in self.OPEN_TAGS + self.CLOSE_TAGS):
+                break
+            output.append('<')
+            position += 1
+        self.buffer = buffer[position:]
+        return self._emit(''.join(output))
+
+    def _find_close(self, buffer, position):
+        size = len(self.closing)
+        start = buffer.find('</', position)
+        while start != -1 and buffer[start:start + size].lower() != self.closing:
+            start = buffer.find('</', start + 2)
+        return start
+
+    def flush(self):
+        remaining = "" if self.closing else self.buffer
+        self.buffer = ""
+        self.closing = None
+        return self._emit(remaining)
+
+    def _emit(self, text):
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+
+class ThreadLocalStdout:
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def redirect(self, sink):
+        self.local.sink = sink
+
+    def write(self, text):
+        return (getattr(self.local, "sink", None) or self.default).write(text)
+
+    def flush(self):
+        (getattr(self.local, "sink", None) or self.default).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+class ClientOutput:
+    def __init__(self, wfile, cancel):
+        self.wfile = wfile
+        self.cancel = cancel
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        try:
+            with self.lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+        except OSError:
+            self.cancel.set()
+
+    def write(self, text):
+        if text:
+            self.send({"type": "output", "text": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def daemon_request(socket_path, request):
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    result = {"type": "error", "text": "daemon closed the connection"}
+    with connection:
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        for line in connection.makefile("r", encoding="utf-8"):
+            message = json.loads(line)
+            if message["type"] == "output":
+                sys.stdout.write(message["text"])
+                sys.stdout.flush()
+            else:
+                result = message
+                break
+    return result
+
+
+def print_models(models=MODELS, current_model=DEFAULT_MODEL, model_usage=None, router=None, tier=1):
+    model_usage = model_usage or {}
+    print("\nAvailable AI Models:")
+    print("=" * 50)
+    if router is not None:
+        current = " <- CURRENT" if current_model == AUTO_MODEL else ""
+        print(f"0. Auto (lowest latency/error score, tier {tier}+){current}")
+    for i, (name, model_id) in enumerate(models, 1):
+        current = " <- CURRENT" if model_id == current_model else ""
+        usage = model_usage.get(name, 0)
+        usage_text = f" ({usage} messages)" if usage > 0 else ""
+        print(f"{i}. {name}{usage_text}{current}")
+        if router is not None:
+            print(f"     tier {MODEL_TIERS.get(model_id, 1)}, {router.describe(model_id)}")
+    print("=" * 50)
+
+
+def profile_startup():
+    import subprocess
+
+    def import_times(statement):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        top_level = {}
+        children = []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            _, cumulative_us, module = line.split("|", 2)
+            depth = (len(module) - len(module.lstrip())) // 2
+            if depth == 0:
+                top_level[module.strip()] = (int(cumulative_us), children)
+                children = []
+            elif depth == 1:
+                children.append((module.strip(), int(cumulative_us)))
+        return top_level
+
+    print("Startup import profile (cumulative ms)")
+    print("=" * 50)
+    total, children = import_times("import ai").get("ai", (0, []))
+    print(f"ai.py fast path (no network stack): {total / 1000:.1f}")
+    for module, cumulative in sorted(children, key=lambda child: child[1], reverse=True):
+        print(f"  {module:<30} {cumulative / 1000:8.1f}")
+
+    print("\nLoaded on first use:")
+    for name in LAZY_MODULES:
+        cumulative, _ = import_times(f"import {name}").get(name, (0, []))
+        print(f"  {name:<30} {cumulative / 1000:8.1f}")
 
 
 class CLIA:
@@ -16,20 +1612,114 @@ class CLIA:
         self.workspace = "workspace"
         os.makedirs(self.workspace, exist_ok=True)
 
-        self.conversation = []
-        self.current_model = "deepseek-ai/DeepSeek-R1-Distill-Llama-70B"
-        self.models = [
-            ("DeepSeek R1 Distill", "deepseek-ai/DeepSeek-R1-Distill-Llama-70B"),
-            ("DeepSeek R1 ", "deepseek-ai/DeepSeek-R1-0528"),
-            ("Llama 3.3", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"),
-            ("AFM 4.5B", "arcee-ai/AFM-4.5B-Preview"),
-            ("EXAONE 3.5 32B", "lgai/exaone-3-5-32b-instruct"),
-            ("EXAONE Deep 32B", "lgai/exaone-deep-32b")
-        ]
+        self.conversation = Conversation()
+        self.request_tokens = []
+        self.current_model = DEFAULT_MODEL
+        self.models = list(MODELS)
         self.session_start = datetime.now()
         self.message_count = 0
         self.model_usage = {}
+        self.stats_lock = threading.Lock()
+        self.stream = False
+        self.last_streamed = False
+        self.http_options = {}
+        self._http = None
+        self.cache_mode = "on"
+        self.cache_options = {}
+        self._cache = None
+        self.max_retries = 3
+        self.backoff_base = 0.5
+        self.backoff_max = 30.0
+        self.hedge_after = None
+        self.hedge_executor = None
+        self.failover = True
+        self.breakers = {}
+        self.dispatch_stats = {}
+        self.journal = None
+        self.rag = False
+        self.rag_top_k = 3
+        self._workspace_index = None
+        self.run_options = {}
+        self._run_engine = None
+        self.metrics = MetricsRecorder()
+        self.jobs = {}
+        self.job_counter = 0
+        self.console_cancel = None
+        self.compare_models = None
+        self.compare_mode = "all"
+        self.compare_outcomes = {}
+        self.assume_yes = False
+        self.tier = 1
+        self.router_options = {}
+        self._router = None
+        self.daemon_sessions = {}
+        self.daemon_started = None
+        self.daemon_requests = Counter()
+        self.daemon_usage = Counter()
+        self.daemon_active = 0
+        self.concurrency = 4
+        self.rate_limit_options = {}
+        self.validate_candidates = 0
+        self.max_continuations = 3
+        self.completion_stats = Counter()
+        self.validate_timeout = 10.0
+        self._rate_limiter = None
         self.load_api_key()
+        self.api_url = os.getenv('CLIA_API_URL', API_URL)
+
+    @property
+    def http(self):
+        if self._http is None:
+            with self.stats_lock:
+                if self._http is None:
+                    self._http = HTTPClient(**self.http_options)
+        return self._http
+
+    @http.setter
+    def http(self, client):
+        self._http = client
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            with self.stats_lock:
+                if self._cache is None:
+                    self._cache = ResponseCache(os.path.join(self.workspace, ".clia", "cache"), **self.cache_options)
+        return self._cache
+
+    @property
+    def router(self):
+        if self._router is None:
+            with self.stats_lock:
+                if self._router is None:
+                    self._router = ModelRouter(os.path.join(self.workspace, ".clia", "router.json"),
+                                               **self.router_options)
+        return self._router
+
+    @property
+    def rate_limiter(self):
+        if self._rate_limiter is None:
+            with self.stats_lock:
+                if self._rate_limiter is None:
+                    account = hashlib.sha256((self.api_key or "").encode("utf-8")).hexdigest()[:12]
+                    self._rate_limiter = SharedRateLimiter(
+                        os.path.join(self.workspace, ".clia", f"ratelimit-{account}.json"), **self.rate_limit_options)
+        return self._rate_limiter
+
+    def tier_models(self):
+        models = [model_id for _, model_id in self.models if MODEL_TIERS.get(model_id, 1) >= self.tier]
+        return models or [model_id for _, model_id in self.models]
+
+    def eligible_models(self):
+        models = self.tier_models()
+        available = [model_id for model_id in models if self._breaker(model_id).state != "open"]
+        return available or models
+
+    def select_model(self, model=None):
+        model = model or self.current_model
+        if model == AUTO_MODEL:
+            return self.router.choose(self.eligible_models())
+        return model
 
     def _full_path(self, filename):
         return os.path.join(self.workspace, filename)
@@ -50,35 +1740,94 @@ class CLIA:
         except Exception as e:
             print(f"Error writing file: {e}")
 
-    def read_file(self, filename):
+    def read_file(self, filename, page_lines=PAGE_LINES):
         filepath = self._full_path(filename)
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                print(f"\nContent of {filename}:\n{'='*40}")
-                print(f.read())
+            size = os.path.getsize(filepath)
+            if size <= PAGE_THRESHOLD:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    print(f"\nContent of {filename}:\n{'='*40}")
+                    print(f.read())
+                return
+            self._page_file(filename, filepath, size, page_lines)
         except Exception as e:
             print(f"Error reading file: {e}")
 
-    def run_file(self, filename):
+    def _page_file(self, filename, filepath, size, page_lines):
+        print(f"\nContent of {filename} ({size / (1024 * 1024):.1f} MB, {page_lines} lines per page):\n{'='*40}")
+        line_number = 0
+        with open(filepath, 'rb') as f:
+            while True:
+                page = []
+                while len(page) < page_lines:
+                    line = f.readline(MAX_LINE_BYTES)
+                    if not line:
+                        break
+                    page.append(line)
+                    if line.endswith(b"\n"):
+                        line_number += 1
+                if not page:
+                    break
+                text = b"".join(page).decode('utf-8', errors='replace')
+                print(text, end="" if text.endswith("\n") else "\n")
+                position = f.tell()
+                if position >= size:
+                    break
+                choice = input(f"-- line {line_number}, {position * 100 // size}% -- "
+                               f"Enter for more, q to stop: ").strip().lower()
+                if choice == 'q':
+                    break
+
+    @property
+    def run_engine(self):
+        if self._run_engine is None:
+            with self.stats_lock:
+                if self._run_engine is None:
+                    self._run_engine = RunEngine(**self.run_options)
+        return self._run_engine
+
+    def run_file(self, filename, timeout=None):
         filepath = self._full_path(filename)
+        if not os.path.isfile(filepath):
+            print(f"Error running file: {filepath} not found")
+            return None
         try:
-            result = subprocess.run(['python', filepath], capture_output=True, text=True)
-            print(f"\nOutput:\n{result.stdout}")
-            if result.stderr:
-                print(f"Errors:\n{result.stderr}")
+            print("\nOutput:")
+            record = self.run_engine.run(filepath, timeout)
         except Exception as e:
             print(f"Error running file: {e}")
+            return None
+        print(f"\n{self._format_run(record)}")
+        return record
+
+    @staticmethod
+    def _format_run(record):
+        rss = f", peak RSS {record['peak_rss_kb'] / 1024:.1f} MB" if record["peak_rss_kb"] else ""
+        warm = " (warm worker)" if record["warm"] else ""
+        return (f"[{record['status']}] exit code {record['exit_code']} "
+                f"in {record['duration']:.2f}s{rss}{warm}")
+
+    def show_runs(self):
+        history = self._run_engine.history if self._run_engine is not None else []
+        if not history:
+            print("No runs yet")
+            return
+        print("\nRun History:")
+        for record in history[-20:]:
+            print(f"  {os.path.basename(record['file'])}: {self._format_run(record)}")
 
     def list_files(self):
         try:
             print("\nFiles in workspace directory:")
             for f in os.listdir(self.workspace):
-                print(f)
+                if not f.startswith('.'):
+                    print(f)
         except Exception as e:
             print(f"Error listing files: {e}")
 
     def load_api_key(self):
         try:
+            from dotenv import load_dotenv
             load_dotenv(self.env_file)
             self.api_key = os.getenv('TOGETHER_API_KEY')
             if self.api_key:
@@ -113,6 +1862,7 @@ class CLIA:
             if not os.path.exists(self.env_file):
                 with open(self.env_file, 'w') as f:
                     f.write("# CLIA environment variables\n")
+            from dotenv import set_key
             set_key(self.env_file, 'TOGETHER_API_KEY', self.api_key)
             print("API key saved to .env file")
         except Exception as e:
@@ -153,91 +1903,650 @@ class CLIA:
     def clean_thinking_text(text):
         cleaned = re.sub(r'<think>.*?</think>', '', text, flags=re.IGNORECASE | re.DOTALL)
         cleaned = re.sub(r'<thought>.*?</thought>', '', cleaned, flags=re.IGNORECASE | re.DOTALL)
+        cleaned = re.sub(r'<(think|thought)>.*', '', cleaned, flags=re.IGNORECASE | re.DOTALL)
         cleaned = re.sub(r'</thought>', '', cleaned, flags=re.IGNORECASE)
         cleaned = re.sub(r'</think>', '', cleaned, flags=re.IGNORECASE)
         cleaned = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned)
         return cleaned.strip()
 
-    def send_message(self, prompt):
+    @staticmethod
+    def clean_thinking_stream(chunks, started=False, thinking_filter=None):
+        shared = thinking_filter is not None
+        thinking_filter = thinking_filter if shared else ThinkingFilter(started)
+        for chunk in chunks:
+            text = thinking_filter.feed(chunk)
+            if text:
+                yield text
+        if shared:
+            return
+        text = thinking_filter.flush()
+        if text:
+            yield text
+
+    @classmethod
+    def clean_generated_content(cls, file_content):
+        file_content = cls.clean_thinking_text(file_content.strip())
+
+        if file_content.startswith('```'):
+            lines = file_content.split('\n')
+            if lines[0].startswith('```'):
+                lines = lines[1:]
+            if lines and lines[-1].strip() == '```':
+                lines = lines[:-1]
+            file_content = '\n'.join(lines)
+
+        lines = file_content.split('\n')
+        cleaned_lines = []
+        for line in lines:
+            if not (line.strip().startswith('// filepath:') or
+                   line.strip().startswith('# filepath:') or
+                   line.strip().startswith('<!-- filepath:')):
+                cleaned_lines.append(line)
+
+        return '\n'.join(cleaned_lines).strip()
+
+    def _post(self, payload, stream=False):
+        self.http.authorize(self.api_key)
+        return self.http.post(self.api_url, payload, stream=stream)
+
+    def _throttle(self, messages, max_tokens):
+        reserved = sum(Conversation.estimate_tokens(message) for message in messages) + max_tokens
+        self.rate_limiter.acquire(reserved)
+        return reserved
+
+    def _settle(self, reserved, response=None, usage=None):
+        headers = getattr(response, "headers", None) or {}
+        status = getattr(response, "status_code", None)
+        retry_after = None
+        if status == 429:
+            retry_after = APIError.parse_retry_after(headers.get("Retry-After")) or 1.0
+        used = (usage or {}).get("total_tokens", reserved) if status == 200 else 0
+        self.rate_limiter.settle(headers, reserved, used, retry_after)
+
+    def _record_request(self, model, start_time, response=None, response_bytes=0, usage=None, status=None):
+        timings = getattr(response, "timings", None) or {}
+        total = time.perf_counter() - start_time
+        usage = usage or {}
+        completion_tokens = usage.get("completion_tokens")
+        self.metrics.record({
+            "time": time.time(),
+            "model": model,
+            "status": status if status is not None else response.status_code,
+            "connect": timings.get("connect", 0.0),
+            "tls": timings.get("tls", 0.0),
+            "ttfb": timings.get("ttfb", total),
+            "total": total,
+            "reused_connection": timings.get("reused"),
+            "request_bytes": timings.get("request_bytes", 0),
+            "response_bytes": response_bytes,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": completion_tokens / total if completion_tokens and total > 0 else None
+        })
+        if status != "cancelled":
+            self.router.observe(model, total, status is None and response.status_code == 200)
+
+    def _request_completion(self, messages, max_tokens, temperature, model=None, meta=None):
+        model = model or self.current_model
+        self.http.authorize(self.api_key)
+        reserved = self._throttle(messages, max_tokens)
+        start_time = time.perf_counter()
+        try:
+            response = self._post({
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature
+            })
+        except Exception as e:
+            self._settle(reserved)
+            self._record_request(model, start_time, status=type(e).__name__)
+            raise
+        if response.status_code != 200:
+            self._settle(reserved, response)
+            self._record_request(model, start_time, response, len(response.content))
+            raise APIError.from_response(response)
+        data = response.json()
+        self._settle(reserved, response, data.get("usage"))
+        self._record_request(model, start_time, response, len(response.content), data.get("usage"))
+        if meta is not None:
+            meta["finish_reason"] = data["choices"][0].get("finish_reason")
+        return data["choices"][0]["message"]["content"]
+
+    def _iter_stream(self, response, meta):
+        for line in response.iter_lines(chunk_size=None):
+            check_cancelled()
+            meta["bytes"] = meta.get("bytes", 0) + len(line) + 1
+            if not line:
+                continue
+            line = line.decode('utf-8')
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            event = json.loads(data)
+            if event.get("usage"):
+                meta["usage"] = event["usage"]
+            choices = event.get("choices") or [{}]
+            if choices[0].get("finish_reason"):
+                meta["finish_reason"] = choices[0]["finish_reason"]
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                yield content
+
+    def _stream_completion(self, messages, max_tokens, temperature, start_time, model=None, sink=None, meta=None):
+        model = model or self.current_model
+        self.http.authorize(self.api_key)
+        reserved = self._throttle(messages, max_tokens)
+        request_start = time.perf_counter()
+        try:
+            response = self._post({
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True
+            }, stream=True)
+        except Exception as e:
+            self._settle(reserved)
+            self._record_request(model, request_start, status=type(e).__name__)
+            raise
+        stream_meta = {}
+        with response:
+            if response.status_code != 200:
+                self._settle(reserved, response)
+                self._record_request(model, request_start, response, len(response.content))
+                raise APIError.from_response(response)
+            raw = []
+            first_token_time = None
+
+            def tokens():
+                nonlocal first_token_time
+                for token in self._iter_stream(response, stream_meta):
+                    if first_token_time is None:
+                        first_token_time = time.time() - start_time
+                    raw.append(token)
+                    yield token
+
+            import requests
+            try:
+                (sink or self._print_stream)(tokens())
+            except TurnCancelled:
+                self._record_request(model, request_start, response, stream_meta.get("bytes", 0), status="cancelled")
+                raise
+            except requests.RequestException as e:
+                self._record_request(model, request_start, response, stream_meta.get("bytes", 0), status=type(e).__name__)
+                if raw:
+                    raise StreamInterrupted(f"stream interrupted: {e}")
+                raise
+        self._settle(reserved, response, stream_meta.get("usage"))
+        self._record_request(model, request_start, response, stream_meta.get("bytes", 0), stream_meta.get("usage"))
+        if meta is not None:
+            meta["finish_reason"] = stream_meta.get("finish_reason")
+        return ''.join(raw), first_token_time
+
+    def _print_stream(self, chunks, clear=True, newline=True, thinking_filter=None):
+        printed = False
+        if thinking_filter is not None:
+            clear = not thinking_filter.started
+        for text in self.clean_thinking_stream(chunks, started=not clear, thinking_filter=thinking_filter):
+            if not printed and clear:
+                print("\r" + " " * 40 + "\r", end="")
+            printed = True
+            print(text, end="", flush=True)
+        if printed:
+            if newline:
+                print()
+            self.last_streamed = True
+
+    def _complete(self, messages, max_tokens, temperature, start_time, model=None, stream=None, failover=True,
+                  sink=None, meta=None, cache=None):
+        model = self.select_model(model)
+        meta = {} if meta is None else meta
+        stream = self.stream if stream is None else stream
+        if cache is None:
+            cache = self.cache_mode == "all" or temperature <= CACHE_MAX_TEMPERATURE
+        key = None
+        if self.cache_mode == "only" or (self.cache_mode != "off" and cache):
+            key = ResponseCache.make_key(model, messages, temperature, max_tokens)
+            cached = self.cache.get(key)
+            if cached is not None:
+                if stream:
+                    (sink or self._print_stream)([cached])
+                return cached, None, model
+            if self.cache_mode == "only":
+                raise CacheMiss("no cached response for this request (--cache-only)")
+
+        raw, first_token_time, used_model = self._dispatch(
+            messages, max_tokens, temperature, start_time, model, stream, failover, sink, meta)
+
+        if key is not None and meta.get("finish_reason") != "length":
+            if used_model != model:
+                key = ResponseCache.make_key(used_model, messages, temperature, max_tokens)
+            self.cache.put(key, raw)
+        return raw, first_token_time, used_model
+
+    def _pick_max_tokens(self, kind, prompt, model, prompt_tokens=0):
+        if kind == "chat" and CODE_REQUEST.search(prompt):
+            kind = "code"
+        elif kind == "chat" and len(prompt) < 200 and not LONG_REQUEST.search(prompt):
+            kind = "short"
+        desired = OUTPUT_BUDGETS[kind] * (2 if model in REASONING_MODELS else 1)
+        available = self.get_context_limit(model) - prompt_tokens - 64
+        return max(MIN_OUTPUT_TOKENS, min(desired, available))
+
+    @classmethod
+    def stitch_continuation(cls, text, more):
+        state = ThinkingFilter()
+        state.feed(text)
+        if state.closing:
+            stripped = more.lstrip()
+            if stripped.lower().startswith(state.closing.replace("/", "")):
+                more = stripped[len(state.closing) - 1:]
+            return text + more
+        visible = cls.clean_thinking_text(text)
+        head = ""
+        match = re.match(r"\s*<(think|thought)>.*?</\1>\s*", more, re.I | re.S)
+        if match:
+            head, more = more[:match.end()], more[match.end():]
+        if visible.count("```") % 2:
+            reopened = re.match(r"\s*```[\w+#.-]*[ \t]*\n", more)
+            if reopened:
+                more = more[reopened.end():]
+                partial = visible.rsplit("\n", 1)[-1]
+                if partial and more.startswith(partial) and text.endswith(partial):
+                    text = text[:-len(partial)]
+        for size in range(min(len(visible), len(more), 200), 19, -1):
+            if visible.endswith(more[:size]):
+                more = more[size:]
+                break
+        return text + head + more
+
+    def _drive_completion(self, messages, max_tokens, temperature, start_time, model=None, stream=None,
+                          failover=True, sink=None, cache=None):
+        stream = self.stream if stream is None else stream
+        printing = stream and sink is None
+        if printing:
+            from functools import partial
+            thinking_filter = ThinkingFilter()
+            sink = partial(self._print_stream, newline=False, thinking_filter=thinking_filter)
+        meta = {}
+        try:
+            raw, first_token_time, used_model = self._complete(messages, max_tokens, temperature, start_time, model,
+                                                               stream, failover, sink, meta, cache)
+            if meta.get("finish_reason") != "length":
+                return raw, first_token_time, used_model
+            return self._continue_completion(messages, raw, first_token_time, used_model, max_tokens, temperature,
+                                             start_time, stream, sink, cache)
+        finally:
+            if printing:
+                started = thinking_filter.started
+                tail = thinking_filter.flush()
+                if tail:
+                    self._print_stream([tail], clear=not started, newline=False)
+                if thinking_filter.started:
+                    print()
+
+    def _continue_completion(self, messages, raw, first_token_time, used_model, max_tokens, temperature,
+                             start_time, stream, sink, cache=None):
+        with self.stats_lock:
+            self.completion_stats["truncated"] += 1
+        prompt_tokens = sum(Conversation.estimate_tokens(message) for message in messages)
+        for _ in range(self.max_continuations):
+            check_cancelled()
+            state = ThinkingFilter()
+            state.feed(raw)
+            sent = raw if state.closing else self.clean_thinking_text(raw)
+            follow = messages + [{"role": "assistant", "content": sent}, {"role": "user", "content": CONTINUE_PROMPT}]
+            room = (self.get_context_limit(used_model) - prompt_tokens - 64
+                    - Conversation.estimate_tokens(follow[-2]) - Conversation.estimate_tokens(follow[-1]))
+            if room < MIN_OUTPUT_TOKENS:
+                break
+            with self.stats_lock:
+                self.completion_stats["continuations"] += 1
+            meta = {}
+            more, _, used_model = self._complete(follow, min(max_tokens, room), temperature, start_time, used_model,
+                                                 stream, False, sink, meta, cache)
+            raw = self.stitch_continuation(raw, more)
+            if meta.get("finish_reason") != "length":
+                with self.stats_lock:
+                    self.completion_stats["completed"] += 1
+                return raw, first_token_time, used_model
+        with self.stats_lock:
+            self.completion_stats["incomplete"] += 1
+        return raw, first_token_time, used_model
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.dispatch_stats[name] = self.dispatch_stats.get(name, 0) + 1
+
+    def _breaker(self, model):
+        with self.stats_lock:
+            return self.breakers.setdefault(model, CircuitBreaker())
+
+    def _fallback_chain(self, model):
+        chain = [model]
+        if self.failover:
+            if self.current_model == AUTO_MODEL:
+                chain += self.router.rank([model_id for model_id in self.tier_models() if model_id != model])
+            else:
+                chain += [model_id for _, model_id in self.models if model_id != model]
+        return chain
+
+    @staticmethod
+    def _is_retryable(error):
+        import requests
+        if isinstance(error, APIError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _dispatch(self, messages, max_tokens, temperature, start_time, model, stream, failover=True, sink=None,
+                  meta=None):
+        last_error = None
+        for candidate in self._fallback_chain(model) if failover else [model]:
+            breaker = self._breaker(candidate)
+            if not breaker.allow():
+                self._count("circuit_skips")
+                continue
+            if candidate != model:
+                self._count("failovers")
+
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if stream:
+                        raw, first_token_time = self._stream_completion(
+                            messages, max_tokens, temperature, start_time, candidate, sink, meta)
+                    else:
+                        raw, first_token_time = self._hedged_completion(
+                            messages, max_tokens, temperature, candidate, meta), None
+                except Exception as e:
+                    if not self._is_retryable(e):
+                        raise
+                    if getattr(e, "status_code", None) != 429:
+                        breaker.record_failure()
+                    last_error = e
+                    retry_after = getattr(e, "retry_after", None)
+                    if attempt == self.max_retries or breaker.state != "closed":
+                        break
+                    if retry_after is not None and retry_after > self.backoff_max:
+                        break
+                    self._count("retries")
+                    cancellable_sleep(self._backoff_delay(attempt, retry_after))
+                    continue
+                breaker.record_success()
+                return raw, first_token_time, candidate
+
+        raise last_error or Exception("all models unavailable (circuit breakers open)")
+
+    def _hedged_completion(self, messages, max_tokens, temperature, model, meta=None):
+        if not self.hedge_after:
+            return self._request_completion(messages, max_tokens, temperature, model, meta)
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        if self.hedge_executor is None:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=8)
+
+        metas = {}
+        primary = self.hedge_executor.submit(self._request_completion, messages, max_tokens, temperature, model,
+                                             metas.setdefault("primary", {}))
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            if meta is not None:
+                meta.update(metas["primary"])
+            return primary.result()
+
+        self._count("hedged")
+        backup = self.hedge_executor.submit(self._request_completion, messages, max_tokens, temperature, model,
+                                            metas.setdefault("backup", {}))
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self._count("hedge_wins")
+                    if meta is not None:
+                        meta.update(metas["backup" if future is backup else "primary"])
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def send_message(self, prompt, cancel=None, cache=None):
         if not self.get_api_key():
             return "No API key"
 
-        self.conversation.append({"role": "user", "content": prompt})
+        user_message = {"role": "user", "content": prompt}
         self.message_count += 1
 
-        model_name = self.get_current_model_name()
-        self.model_usage[model_name] = self.model_usage.get(model_name, 0) + 1
-
+        self.last_streamed = False
+        _turn_state.cancel = cancel
         try:
             print("Thinking...", end="", flush=True)
             start_time = time.time()
 
-            response = requests.post(
-                "https://api.together.xyz/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": self.current_model,
-                    "messages": self.conversation,
-                    "max_tokens": 1000,
-                    "temperature": 0.7
-                }
-            )
+            model = self.select_model()
+            budget = self.get_context_limit(model) - self._pick_max_tokens("chat", prompt, model)
+            context = self.get_workspace_context(prompt) if self.rag else ""
+            if context:
+                context_message = {"role": "system", "content": context}
+                budget -= Conversation.estimate_tokens(context_message)
+            messages, tokens_sent, dropped = self.conversation.window(budget, pending=[user_message])
+            if context:
+                messages.insert(0, context_message)
+                tokens_sent += Conversation.estimate_tokens(context_message)
+            with self.stats_lock:
+                self.request_tokens.append((tokens_sent, dropped))
+            if dropped:
+                print(f"\rContext budget: dropped {dropped} older messages", flush=True)
+                print("Thinking...", end="", flush=True)
+            max_tokens = self._pick_max_tokens("chat", prompt, model, tokens_sent)
+            result, first_token_time, used_model = self._drive_completion(messages, max_tokens, 0.7, start_time, model,
+                                                                          cache=cache)
+            check_cancelled()
 
             response_time = time.time() - start_time
-            print(f"\rResponse time: {response_time:.2f}s")
+            print(f"\rResponse time: {response_time:.2f}s{self._first_token_text(first_token_time)}"
+                  f"{self._fallback_text(used_model)}")
+            self._record_usage(used_model)
 
-            if response.status_code == 200:
-                result = response.json()["choices"][0]["message"]["content"]
-                result = self.clean_thinking_text(result)
+            result = self.clean_thinking_text(result)
+            with self.stats_lock:
+                check_cancelled()
+                self.conversation.append(user_message)
                 self.conversation.append({"role": "assistant", "content": result})
-                return result
-            else:
-                self.conversation.pop()
-                return f"Error: {response.status_code} - {response.text}"
+            self._journal({"type": "turn", "model": self.current_model, "answered_by": used_model,
+                           "user": prompt, "assistant": result})
+            return result
 
+        except TurnCancelled:
+            raise
         except Exception as e:
-            self.conversation.pop()
+            self._record_usage(self.current_model)
             return f"Error: {e}"
+        finally:
+            _turn_state.cancel = None
+
+    @staticmethod
+    def _first_token_text(first_token_time):
+        if first_token_time is None:
+            return ""
+        return f" (first token: {first_token_time:.2f}s)"
+
+    def _fallback_text(self, used_model):
+        if self.current_model == AUTO_MODEL:
+            return f" [auto: {self.get_model_name(used_model)}]"
+        if used_model == self.current_model:
+            return ""
+        return f" via {self.get_model_name(used_model)}"
+
+    def _record_usage(self, model_id):
+        name = self.get_model_name(model_id)
+        with self.stats_lock:
+            self.model_usage[name] = self.model_usage.get(name, 0) + 1
+
+    def respond(self, prompt, cache=None):
+        response = self.send_message(prompt, cache=cache)
+        if not self.last_streamed:
+            print(response)
+
+    def parse_model_selection(self, spec):
+        if not spec or spec.strip().lower() == "all":
+            return [model_id for _, model_id in self.models]
+        selected = []
+        for part in spec.split(","):
+            model_id = self.resolve_model(part.strip())
+            if model_id not in selected:
+                selected.append(model_id)
+        return selected
+
+    @staticmethod
+    def _drain(chunks):
+        for _ in chunks:
+            pass
+
+    def _compare_one(self, messages, model, cancel):
+        _turn_state.cancel = cancel
+        start_time = time.time()
+        outcome = {"model": model}
+        try:
+            max_tokens = self._pick_max_tokens("chat", messages[-1]["content"], model,
+                                               sum(Conversation.estimate_tokens(message) for message in messages))
+            raw, _, _ = self._drive_completion(messages, max_tokens, 0.7, start_time, model=model, stream=True,
+                                               failover=False, sink=self._drain)
+            check_cancelled()
+            outcome["reply"] = self.clean_thinking_text(raw)
+            outcome["status"] = "ok" if outcome["reply"] else "empty"
+        except TurnCancelled:
+            outcome["status"] = "cancelled"
+        except Exception as e:
+            outcome["status"] = "error"
+            outcome["error"] = str(e)
+        finally:
+            _turn_state.cancel = None
+        outcome["latency"] = time.time() - start_time
+        return outcome
+
+    def compare(self, prompt, models=None, mode="all"):
+        if not self.get_api_key():
+            return None
+        models = models or self.parse_model_selection(None)
+        user_message = {"role": "user", "content": prompt}
+        budget = min(self.get_context_limit(model) - self._pick_max_tokens("chat", prompt, model) for model in models)
+        messages, _, _ = self.conversation.window(budget, pending=[user_message])
+        self.message_count += 1
+
+        print(f"Asking {len(models)} models ({mode})...", flush=True)
+        start_time = time.time()
+        cancel = threading.Event()
+        futures = [run_detached(self._compare_one, messages, model, cancel) for model in models]
+        outcomes = {}
+        winner = None
+        try:
+            for future in as_completed_cancellable(futures):
+                outcome = future.result()
+                outcomes[outcome["model"]] = outcome
+                if outcome["status"] == "ok" and winner is None:
+                    winner = outcome
+                    if mode == "race":
+                        cancel.set()
+                        break
+        except TurnCancelled:
+            cancel.set()
+            raise
+        wall_time = time.time() - start_time
+        for model in models:
+            outcomes.setdefault(model, {"model": model, "status": "cancelled", "latency": wall_time})
+
+        with self.stats_lock:
+            for outcome in outcomes.values():
+                name = self.get_model_name(outcome["model"])
+                self.model_usage[name] = self.model_usage.get(name, 0) + 1
+                results = self.compare_outcomes.setdefault(name, Counter())
+                results["win" if outcome is winner else outcome["status"]] += 1
+
+        ordered = sorted(outcomes.values(), key=lambda o: (o["status"] != "ok", o["latency"]))
+        shown = [winner] if mode == "race" and winner else [o for o in ordered if o["status"] == "ok"]
+        for outcome in shown:
+            print(f"\n--- {self.get_model_name(outcome['model'])} ({outcome['latency']:.2f}s) ---")
+            print(outcome["reply"])
+
+        serial_time = sum(o["latency"] for o in outcomes.values() if o["status"] != "cancelled")
+        print(f"\nWall time {wall_time:.2f}s (serial sum {serial_time:.2f}s)")
+        for outcome in ordered:
+            marker = "*" if outcome is winner else " "
+            detail = f" - {outcome['error']}" if outcome.get("error") else ""
+            print(f" {marker} {self.get_model_name(outcome['model']):<25} {outcome['status']:<10} "
+                  f"{outcome['latency']:.2f}s{detail}")
+
+        if winner is None:
+            print("No model returned an answer")
+            return None
+        with self.stats_lock:
+            self.conversation.append(user_message)
+            self.conversation.append({"role": "assistant", "content": winner["reply"]})
+        self._journal({"type": "turn", "model": self.current_model, "answered_by": winner["model"],
+                       "user": prompt, "assistant": winner["reply"]})
+        print(f"Recorded reply from {self.get_model_name(winner['model'])}")
+        return winner["reply"]
 
     def show_models(self):
-        print("\nAvailable AI Models:")
-        print("=" * 50)
-        for i, (name, model_id) in enumerate(self.models, 1):
-            current = " <- CURRENT" if model_id == self.current_model else ""
-            usage = self.model_usage.get(name, 0)
-            usage_text = f" ({usage} messages)" if usage > 0 else ""
-            print(f"{i}. {name}{usage_text}{current}")
-        print("=" * 50)
+        print_models(self.models, self.current_model, self.model_usage, self.router, self.tier)
 
     def change_model(self, model_number=None):
         if model_number is None:
             self.show_models()
             try:
-                choice = input(f"Select model (1-{len(self.models)}): ").strip()
+                choice = input(f"Select model (0-{len(self.models)}, 0 = auto): ").strip()
                 if choice.lower() == 'q':
                     return
-                model_number = int(choice)
+                model_number = 0 if choice.lower() == AUTO_MODEL else int(choice)
             except ValueError:
                 print("Invalid input")
                 return
 
-        if 1 <= model_number <= len(self.models):
+        if model_number == 0:
+            old_model = self.get_current_model_name()
+            self.current_model = AUTO_MODEL
+            print(f"Switched from {old_model} to automatic routing (tier {self.tier}+)")
+        elif 1 <= model_number <= len(self.models):
             old_model = self.get_current_model_name()
             self.current_model = self.models[model_number - 1][1]
             new_model = self.get_current_model_name()
             print(f"Switched from {old_model} to {new_model}")
         else:
-            print(f"Invalid choice. Select 1-{len(self.models)}")
+            print(f"Invalid choice. Select 0-{len(self.models)}")
 
     def get_current_model_name(self):
-        for name, model_id in self.models:
-            if model_id == self.current_model:
+        return self.get_model_name(self.current_model)
+
+    def get_model_name(self, model_id):
+        if model_id == AUTO_MODEL:
+            return "Auto"
+        for name, known_id in self.models:
+            if known_id == model_id:
                 return name
         return "Unknown"
 
+    @staticmethod
+    def get_context_limit(model_id):
+        return MODEL_CONTEXT.get(model_id, DEFAULT_CONTEXT)
+
+    def resolve_model(self, value):
+        if value is None or value == "":
+            return self.current_model
+        if isinstance(value, int) or str(value).isdigit():
+            index = int(value)
+            if 1 <= index <= len(self.models):
+                return self.models[index - 1][1]
+            raise ValueError(f"Invalid model number {index}. Select 1-{len(self.models)}")
+        return str(value)
+
     def show_stats(self):
         session_time = datetime.now() - self.session_start
         print(f"\nSession Statistics:")
@@ -245,11 +2554,62 @@ class CLIA:
         print(f"Session Duration: {str(session_time).split('.')[0]}")
         print(f"Total Messages: {self.message_count}")
         print(f"Current Model: {self.get_current_model_name()}")
-        print(f"Conversation Length: {len(self.conversation)} turns")
+        print(f"Conversation Length: {len(self.conversation)} turns "
+              f"(~{self.conversation.total_tokens} tokens)")
+        if self.request_tokens:
+            sent = [tokens for tokens, _ in self.request_tokens]
+            print(f"Tokens Sent: {sum(sent)} total, {sum(sent) // len(sent)} avg per request")
+            for number, (tokens, dropped) in enumerate(self.request_tokens[-10:],
+                                                       max(1, len(self.request_tokens) - 9)):
+                dropped_text = f" ({dropped} messages dropped)" if dropped else ""
+                print(f"  Request {number}: ~{tokens} tokens{dropped_text}")
+        self._show_transport_stats()
         if self.model_usage:
             print("\nModel Usage:")
             for model, count in self.model_usage.items():
-                print(f"  {model}: {count} messages")
+                outcomes = self.compare_outcomes.get(model)
+                detail = ""
+                if outcomes:
+                    detail = " (compare: " + ", ".join(f"{n} {status}" for status, n in outcomes.most_common()) + ")"
+                print(f"  {model}: {count} messages{detail}")
+        self._show_latency_stats()
+
+    def _show_transport_stats(self):
+        http_stats = self._http.stats() if self._http is not None else {"requests": 0}
+        if http_stats["requests"]:
+            print(f"HTTP Requests: {http_stats['requests']} "
+                  f"({http_stats['connections']} connections opened, {http_stats['reused']} reused)")
+        if self.dispatch_stats:
+            print("Dispatch: " + ", ".join(f"{count} {name.replace('_', ' ')}"
+                                           for name, count in sorted(self.dispatch_stats.items())))
+        for model_id, breaker in sorted(self.breakers.items()):
+            if breaker.state != "closed":
+                print(f"Circuit {breaker.state}: {self.get_model_name(model_id)}")
+        if self.completion_stats["truncated"]:
+            stats = self.completion_stats
+            print(f"Truncated responses: {stats['truncated']} ({stats['continuations']} continuation requests, "
+                  f"{stats['completed']} completed, {stats['incomplete']} still cut off)")
+        if self._rate_limiter is not None and (self._rate_limiter.waits or self._rate_limiter.describe()):
+            limiter = self._rate_limiter
+            print(f"Rate limit: {limiter.describe() or 'no limits known'}; "
+                  f"{limiter.waits} requests queued for {limiter.waited:.2f}s")
+        if self._cache is not None:
+            print(f"Cache: {self.cache.hits} hits, {self.cache.misses} misses, "
+                  f"{self.cache.bytes_saved} bytes saved ({self.cache.size()} bytes stored)")
+
+    def _show_latency_stats(self):
+        latency = self.metrics.summary()
+        if latency:
+            print("\nRequest Latency:")
+            for model_id, (count, p50, p95, p99) in latency.items():
+                print(f"  {self.get_model_name(model_id)}: {count} requests, "
+                      f"p50 {p50:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s")
+            last = self.metrics.records[-1]
+            speed = f", {last['tokens_per_second']:.1f} tok/s" if last["tokens_per_second"] else ""
+            connection = "reused connection" if last["reused_connection"] else \
+                f"connect {last['connect'] * 1000:.0f}ms (incl. dns), tls {last['tls'] * 1000:.0f}ms"
+            print(f"  Last request: {connection}, ttfb {last['ttfb']:.2f}s, total {last['total']:.2f}s, "
+                  f"{last['request_bytes']}B sent, {last['response_bytes']}B received{speed}")
 
     def save_conversation(self, filename=None):
         if not self.conversation:
@@ -263,130 +2623,802 @@ class CLIA:
                 json.dump({
                     "session_start": self.session_start.isoformat(),
                     "model_used": self.get_current_model_name(),
-                    "conversation": self.conversation
+                    "tree": self.conversation.to_tree()
                 }, f, indent=2, ensure_ascii=False)
             print(f"Conversation saved to {filename}")
         except Exception as e:
             print(f"Failed to save: {e}")
 
-    #def get_workspace_context(self):
-    # context = []
-    #     try:
-    #         files = os.listdir(self.workspace)
-    #         context.append(f"Workspace contains {len(files)} files:")
-    #
-    #         for filename in files:
-    #             filepath = self._full_path(filename)
-    #             if os.path.isfile(filepath):
-    #                 try:
-    #                     _, ext = os.path.splitext(filename)
-    #                     context.append(f"- {filename} ({ext or 'no extension'})")
-    #
-    #                     if os.path.getsize(filepath) < 2048:
-    #                         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-    #                             content = f.read()
-    #                             if len(content) < 500:
-    #                                 context.append(f"  Content preview: {content[:200]}...")
-    #                 except Exception:
-    #                     context.append(f"- {filename} (binary or unreadable)")
-    #
-    #     except Exception as e:
-    #         context.append(f"Error reading workspace: {e}")
-    #
-    #     return "\n".join(context)
+    def _sessions_dir(self):
+        return os.path.join(self.workspace, ".clia", "sessions")
+
+    def _journal(self, record, base=False):
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(record, base)
+        except Exception as e:
+            print(f"Journal write failed: {e}")
+
+    def _counters_record(self, record_type):
+        return {
+            "type": record_type,
+            "session_start": self.session_start.isoformat(),
+            "model_used": self.get_current_model_name(),
+            "message_count": self.message_count,
+            "model_usage": dict(self.model_usage)
+        }
+
+    def clear_conversation(self):
+        self.conversation.clear()
+        self._journal(self._counters_record("clear"), base=True)
+
+    def _apply_branch(self, conversation, op, name=None):
+        if op == "fork":
+            return conversation.fork(name)
+        if op == "undo":
+            return conversation.undo()
+        conversation.checkout(name)
+        return name
+
+    def _conversation_busy(self, op):
+        if not self.jobs:
+            return False
+        print(f"Cannot {op} while prompts are running or queued (wait for them, or 'cancel all')")
+        return True
+
+    def branch_conversation(self, op, name=None):
+        if self._conversation_busy(op):
+            return None
+        try:
+            with self.stats_lock:
+                result = self._apply_branch(self.conversation, op, name)
+        except ValueError as e:
+            print(e)
+            return None
+        self._journal({"type": "branch", "op": op, "name": result if op == "fork" else name})
+        conversation = self.conversation
+        if op == "fork":
+            print(f"Forked branch {result} at message {len(conversation)}")
+        elif op == "undo":
+            print(f"Removed {result} messages from {conversation.branch}" if result else "Nothing to undo")
+        else:
+            print(f"Switched to {name}: {len(conversation)} messages (~{conversation.total_tokens} tokens)")
+        return result
+
+    def show_branches(self):
+        conversation = self.conversation
+        for name, tip in conversation.branches.items():
+            marker = "*" if name == conversation.branch else " "
+            depth = tip.depth if tip is not None else 0
+            print(f" {marker} {name}: {depth} messages, {conversation.shared_depth(name)} shared with "
+                  f"{conversation.branch}")
+
+    def start_session(self, name=None):
+        name = name or datetime.now().strftime("session_%Y%m%d_%H%M%S")
+        self.journal = SessionJournal(self._sessions_dir(), name)
+        if not self.journal.exists():
+            self._journal({"type": "session", "session_start": self.session_start.isoformat(),
+                           "model": self.current_model})
+        print(f"Session journal: {self.journal.path}")
+
+    def _replay(self, journal):
+        state = {
+            "session_start": None,
+            "conversation": Conversation(),
+            "message_count": 0,
+            "model_usage": {},
+            "model": None
+        }
+        for record in journal.read():
+            record_type = record.get("type")
+            if record_type == "session":
+                state["session_start"] = record.get("session_start")
+                state["model"] = record.get("model")
+            elif record_type in ("snapshot", "clear"):
+                state["session_start"] = record.get("session_start", state["session_start"])
+                state["conversation"] = Conversation.load(record)
+                state["message_count"] = record.get("message_count", 0)
+                state["model_usage"] = dict(record.get("model_usage", {}))
+            elif record_type == "turn":
+                state["conversation"].append({"role": "user", "content": record["user"]})
+                state["conversation"].append({"role": "assistant", "content": record["assistant"]})
+                state["message_count"] += 1
+                name = self.get_model_name(record.get("answered_by") or record.get("model"))
+                state["model_usage"][name] = state["model_usage"].get(name, 0) + 1
+                state["model"] = record.get("model")
+            elif record_type == "branch":
+                try:
+                    self._apply_branch(state["conversation"], record.get("op"), record.get("name"))
+                except ValueError:
+                    pass
+        return state
+
+    def resume_session(self, name):
+        journal = SessionJournal(self._sessions_dir(), name)
+        if not journal.exists():
+            print(f"No session named {name}")
+            return False
+        try:
+            state = self._replay(journal)
+        except Exception as e:
+            print(f"Error resuming session: {e}")
+            return False
+
+        self.conversation = state["conversation"]
+        self.message_count = state["message_count"]
+        self.model_usage = state["model_usage"]
+        if state["session_start"]:
+            self.session_start = datetime.fromisoformat(state["session_start"])
+        if state["model"] == AUTO_MODEL or state["model"] in dict((model_id, name) for name, model_id in self.models):
+            self.current_model = state["model"]
+        self.journal = journal
+        print(f"Resumed session {name}: {len(self.conversation)} messages, {self.message_count} requests")
+        return True
+
+    def compact_session(self, name=None):
+        if name is None and self.journal is None:
+            print("No active session to compact")
+            return
+        if name is None or (self.journal is not None and name == self.journal.name):
+            journal = self.journal
+            snapshot = self._counters_record("snapshot")
+            snapshot["tree"] = self.conversation.to_tree()
+        else:
+            journal = SessionJournal(self._sessions_dir(), name)
+            if not journal.exists():
+                print(f"No session named {name}")
+                return
+            state = self._replay(journal)
+            snapshot = {
+                "type": "snapshot",
+                "session_start": state["session_start"],
+                "model_used": self.get_model_name(state["model"]),
+                "message_count": state["message_count"],
+                "model_usage": state["model_usage"],
+                "tree": state["conversation"].to_tree()
+            }
+        try:
+            before = os.path.getsize(journal.path)
+            journal.compact(snapshot)
+            print(f"Compacted {journal.name}: {before} -> {os.path.getsize(journal.path)} bytes")
+        except Exception as e:
+            print(f"Error compacting session: {e}")
+
+    def list_sessions(self):
+        directory = self._sessions_dir()
+        names = sorted(f[:-6] for f in os.listdir(directory) if f.endswith(".jsonl")) \
+            if os.path.isdir(directory) else []
+        if not names:
+            print("No saved sessions")
+            return
+        print("\nSessions:")
+        for name in names:
+            current = " <- CURRENT" if self.journal is not None and self.journal.name == name else ""
+            size = os.path.getsize(os.path.join(directory, f"{name}.jsonl"))
+            print(f"  {name} ({size} bytes){current}")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        if self._run_engine is not None:
+            self._run_engine.shutdown()
+        if self._router is not None:
+            self._router.save()
+        if self._cache is not None:
+            self._cache.flush()
+        if self._workspace_index is not None:
+            with self._workspace_index.lock:
+                self._workspace_index.save()
+        self.metrics.close()
+
+    @property
+    def workspace_index(self):
+        if self._workspace_index is None:
+            self._workspace_index = WorkspaceIndex(self.workspace, os.path.join(self.workspace, ".clia", "index.json"))
+        return self._workspace_index
+
+    def get_workspace_context(self, query, k=None):
+        try:
+            self.workspace_index.refresh()
+            results = self.workspace_index.query(query, k or self.rag_top_k)
+        except Exception as e:
+            print(f"Workspace index unavailable: {e}")
+            return ""
+        context = []
+        for _, chunk in results:
+            try:
+                text = self.workspace_index.read_chunk(chunk)
+            except OSError:
+                continue
+            relpath, start, end = chunk
+            context.append(f"--- {relpath} (lines {start + 1}-{end}) ---\n{text}")
+        if not context:
+            return ""
+        return "Relevant workspace files:\n" + "\n\n".join(context)
+
+    def rebuild_index(self):
+        start_time = time.time()
+        changed = self.workspace_index.refresh()
+        index = self.workspace_index
+        with index.lock:
+            index.save()
+        print(f"Indexed {len(index.files)} files, {len(index.chunks)} chunks "
+              f"({changed} changed) in {time.time() - start_time:.2f}s")
 
     def ai_create_file(self, description, filename=None):
         if not self.get_api_key():
             print("API key required for AI file creation")
             return
 
+        context = self.get_workspace_context(description) if self.rag else ""
+        if context:
+            context = f"\n{context}\n"
+
         prompt = f"""You are a coding assistant. Create a file based on the following description.
 USER REQUEST: {description}
-
-IMPORTANT RULES:
-- Output ONLY executable code, no explanations, comments, or markdown
-- Do NOT include ```python, ```html, or any code block markers
-- Do NOT include file paths or comments like "// filepath:"
-- Do NOT add explanatory text before or after the code
-- Generate clean, working code that can be saved and run directly
-- If it's a Python file, start directly with imports or code
-- If it's HTML, start directly with <!DOCTYPE html>
-- If it's CSS, start directly with selectors
+{context}
+{FILE_RULES}
 
 Please generate the complete, working file content:"""
 
         try:
-            print("AI is generating file content...", end="", flush=True)
-            start_time = time.time()
+            if self.validate_candidates and not filename:
+                filename = input("Enter filename for the generated content: ").strip()
+                if not filename:
+                    print("No filename provided, canceling file creation")
+                    return
 
-            response = requests.post(
-                "https://api.together.xyz/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": self.current_model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 2000,
-                    "temperature": 0.2
-                }
-            )
+            self.last_streamed = False
+            if self.validate_candidates and filename.endswith(".py"):
+                file_content = self.generate_validated(prompt, filename, self.validate_candidates,
+                                                       self.validate_timeout)
+                if file_content is None:
+                    return
+            else:
+                print("AI is generating file content...", end="", flush=True)
+                start_time = time.time()
 
-            response_time = time.time() - start_time
-            print(f"\rGeneration time: {response_time:.2f}s")
-
-            if response.status_code == 200:
-                file_content = response.json()["choices"][0]["message"]["content"].strip()
-                file_content = self.clean_thinking_text(file_content)
-
-                if file_content.startswith('```'):
-                    lines = file_content.split('\n')
-                    if lines[0].startswith('```'):
-                        lines = lines[1:]
-                    if lines and lines[-1].strip() == '```':
-                        lines = lines[:-1]
-                    file_content = '\n'.join(lines)
-
-                lines = file_content.split('\n')
-                cleaned_lines = []
-                for line in lines:
-                    if not (line.strip().startswith('// filepath:') or
-                           line.strip().startswith('# filepath:') or
-                           line.strip().startswith('<!-- filepath:')):
-                        cleaned_lines.append(line)
-
-                file_content = '\n'.join(cleaned_lines).strip()
+                if self.stream:
+                    print()
+                messages = [{"role": "user", "content": prompt}]
+                model = self.select_model()
+                max_tokens = self._pick_max_tokens("file", prompt, model, Conversation.estimate_tokens(messages[0]))
+                file_content, first_token_time, used_model = self._drive_completion(
+                    messages, max_tokens, 0.2, start_time, model)
+
+                response_time = time.time() - start_time
+                print(f"\rGeneration time: {response_time:.2f}s{self._first_token_text(first_token_time)}"
+                      f"{self._fallback_text(used_model)}")
 
+                file_content = self.clean_generated_content(file_content)
+
+            if not filename:
+                filename = input("Enter filename for the generated content: ").strip()
                 if not filename:
-                    filename = input("Enter filename for the generated content: ").strip()
-                    if not filename:
-                        print("No filename provided, canceling file creation")
-                        return
+                    print("No filename provided, canceling file creation")
+                    return
 
+            if not self.last_streamed:
                 show_content = input("Show generated content? (y/n): ").strip().lower()
                 if show_content in ['y', 'yes']:
                     print(f"\nGenerated content:\n{'='*50}")
                     print(file_content)
                     print('='*50)
 
-                save_choice = input("Save to file? (y/n): ").strip().lower()
-                if save_choice in ['y', 'yes']:
-                    filepath = self._full_path(filename)
-                    try:
-                        with open(filepath, 'w', encoding='utf-8') as f:
-                            f.write(file_content)
-                        print(f"File saved to {filepath}")
-                    except Exception as e:
-                        print(f"Error saving file: {e}")
-                else:
-                    print("File not saved")
+            save_choice = input("Save to file? (y/n): ").strip().lower()
+            if save_choice in ['y', 'yes']:
+                filepath = self._full_path(filename)
+                try:
+                    with open(filepath, 'w', encoding='utf-8') as f:
+                        f.write(file_content)
+                    print(f"File saved to {filepath}")
+                except Exception as e:
+                    print(f"Error saving file: {e}")
             else:
-                print(f"Error generating content: {response.status_code} - {response.text}")
+                print("File not saved")
 
+        except TurnCancelled:
+            raise
+        except APIError as e:
+            print(f"Error generating content: {e}")
         except Exception as e:
             print(f"Error: {e}")
 
+    def _validate_candidate(self, prompt, target, number, temperature, timeout, cancel):
+        _turn_state.cancel = cancel
+        start_time = time.time()
+        record = {"candidate": number, "temperature": temperature}
+        candidate = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.candidate{number}.py")
+        try:
+            messages = [{"role": "user", "content": prompt}]
+            model = self.select_model()
+            max_tokens = self._pick_max_tokens("file", prompt, model, Conversation.estimate_tokens(messages[0]))
+            raw, _, record["model"] = self._drive_completion(messages, max_tokens, temperature, start_time, model,
+                                                             stream=True, sink=self._drain, cache=False)
+            check_cancelled()
+            content = self.clean_generated_content(raw)
+            record["generated"] = time.time() - start_time
+            try:
+                compile(content, target, "exec")
+            except SyntaxError as e:
+                record.update(status="syntax error", error=f"line {e.lineno}: {e.msg}")
+                return record
+            os.makedirs(os.path.dirname(candidate), exist_ok=True)
+            with open(candidate, "w", encoding="utf-8") as f:
+                f.write(content)
+            run = self.run_engine.run(candidate, timeout, echo=False)
+            if run["status"] in ("ok", "timeout"):
+                record.update(status="passed" if run["status"] == "ok" else "still running at timeout",
+                              content=content)
+            elif run["status"] == "cancelled":
+                record["status"] = "cancelled"
+            else:
+                lines = run["stderr_tail"].strip().splitlines()
+                record.update(status=f"exit {run['exit_code']}", error=lines[-1] if lines else "")
+        except TurnCancelled:
+            record["status"] = "cancelled"
+        except Exception as e:
+            record.update(status="error", error=str(e))
+        finally:
+            _turn_state.cancel = None
+            record["duration"] = time.time() - start_time
+            if os.path.exists(candidate):
+                os.remove(candidate)
+        return record
+
+    def generate_validated(self, prompt, filename, candidates=3, timeout=10.0):
+        from concurrent.futures import ThreadPoolExecutor
+        target = self._full_path(filename)
+        temperatures = [round(0.2 + 0.8 * index / max(1, candidates - 1), 2) for index in range(candidates)]
+        print(f"Generating {candidates} candidates for {filename} "
+              f"(temperatures {', '.join(str(t) for t in temperatures)})...")
+        start_time = time.time()
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=candidates)
+        futures = [executor.submit(self._validate_candidate, prompt, target, number, temperature, timeout, cancel)
+                   for number, temperature in enumerate(temperatures, 1)]
+        winner = None
+        tried = 0
+        try:
+            for future in as_completed_cancellable(futures):
+                record = future.result()
+                if record["status"] == "cancelled":
+                    continue
+                tried += 1
+                error = f" - {record['error']}" if record.get("error") else ""
+                print(f"  candidate {record['candidate']} (temperature {record['temperature']}): "
+                      f"{record['status']}{error} ({record['duration']:.2f}s)")
+                if "content" in record:
+                    winner = record
+                    break
+        finally:
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        elapsed = time.time() - start_time
+        with self.stats_lock:
+            self.dispatch_stats["validated_candidates"] = self.dispatch_stats.get("validated_candidates", 0) + tried
+        if winner is None:
+            print(f"No valid candidate: {tried} tried in {elapsed:.2f}s")
+            return None
+        print(f"Valid file after {tried} of {candidates} candidates in {elapsed:.2f}s "
+              f"(generated in {winner['generated']:.2f}s{self._fallback_text(winner['model'])}); "
+              f"{candidates - tried} cancelled")
+        return winner["content"]
+
+    @classmethod
+    def parse_manifest(cls, text):
+        text = cls.clean_thinking_text(text)
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            raise ValueError("planner did not return a JSON manifest")
+        data = json.loads(text[start:end + 1])
+        files = []
+        seen = set()
+        for entry in data.get("files", []):
+            path = os.path.normpath(str(entry.get("path", "")).strip())
+            hidden = any(part.startswith(".") for part in path.split(os.sep))
+            if hidden or os.path.isabs(path) or path in seen:
+                continue
+            seen.add(path)
+            files.append({"path": path, "description": str(entry.get("description", ""))})
+        if not files:
+            raise ValueError("manifest lists no files")
+        return files
+
+    def plan_project(self, description):
+        context = self.get_workspace_context(description) if self.rag else ""
+        if context:
+            context = f"\n{context}\n"
+
+        prompt = f"""You are a software architect. Plan the files for the following project.
+PROJECT: {description}
+{context}
+Respond with ONLY a JSON object, no explanations or markdown, in this form:
+{{"files": [{{"path": "relative/path.ext", "description": "what this file must contain"}}]}}
+Keep the project small and use relative paths only."""
+
+        messages = [{"role": "user", "content": prompt}]
+        model = self.select_model()
+        max_tokens = self._pick_max_tokens("code", prompt, model, Conversation.estimate_tokens(messages[0]))
+        raw, _, _ = self._drive_completion(messages, max_tokens, 0.2, time.time(), model, stream=False)
+        return self.parse_manifest(raw)
+
+    def _generate_project_file(self, description, manifest, entry, cancel=None):
+        _turn_state.cancel = cancel
+        start_time = time.time()
+        target = self._full_path(entry["path"])
+        directory = os.path.dirname(target)
+        partial = os.path.join(directory, f".{os.path.basename(target)}.part")
+        outline = "\n".join(f"- {item['path']}: {item['description']}" for item in manifest)
+        prompt = f"""You are a coding assistant. Create one file of a larger project.
+PROJECT: {description}
+FILES IN THE PROJECT:
+{outline}
+FILE TO WRITE: {entry['path']} - {entry['description']}
+{FILE_RULES}
+
+Please generate the complete, working content of {entry['path']}:"""
+
+        def write_stream(chunks):
+            with open(partial, "w", encoding="utf-8") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+
+        record = {"path": entry["path"]}
+        try:
+            os.makedirs(directory, exist_ok=True)
+            messages = [{"role": "user", "content": prompt}]
+            model = self.select_model()
+            max_tokens = self._pick_max_tokens("file", prompt, model, Conversation.estimate_tokens(messages[0]))
+            raw, _, used_model = self._drive_completion(messages, max_tokens, 0.2, start_time, model,
+                                                        stream=True, sink=write_stream)
+            content = self.clean_generated_content(raw)
+            with open(partial, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial, target)
+            record.update(status="ok", bytes=len(content.encode("utf-8")), model=used_model)
+        except Exception as e:
+            record.update(status="error", error=str(e))
+            if os.path.exists(partial):
+                os.remove(partial)
+        finally:
+            _turn_state.cancel = None
+        record["duration"] = time.time() - start_time
+        return record
+
+    def create_project(self, description, assume_yes=False, concurrency=4):
+        if not self.get_api_key():
+            print("API key required for AI file creation")
+            return None
+
+        print("Planning project...", end="", flush=True)
+        start_time = time.time()
+        try:
+            manifest = self.plan_project(description)
+        except APIError as e:
+            print(f"\rError planning project: {e}")
+            return None
+        except Exception as e:
+            print(f"\rError: {e}")
+            return None
+        print(f"\rPlanned {len(manifest)} files in {time.time() - start_time:.2f}s")
+        for entry in manifest:
+            exists = " (overwrite)" if os.path.exists(self._full_path(entry["path"])) else ""
+            print(f"  {entry['path']}{exists} - {entry['description']}")
+
+        if not assume_yes:
+            choice = input(f"Generate {len(manifest)} files? (y/n): ").strip().lower()
+            if choice not in ['y', 'yes']:
+                print("Project not generated")
+                return None
+
+        from concurrent.futures import ThreadPoolExecutor
+        concurrency = max(1, min(concurrency, len(manifest)))
+        print(f"Generating {len(manifest)} files ({concurrency} at a time)...")
+        start_time = time.time()
+        results = []
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [executor.submit(self._generate_project_file, description, manifest, entry, cancel)
+                   for entry in manifest]
+        try:
+            for future in as_completed_cancellable(futures):
+                record = future.result()
+                results.append(record)
+                if record["status"] == "ok":
+                    print(f"  wrote {record['path']} ({record['bytes']} bytes, {record['duration']:.2f}s"
+                          f"{self._fallback_text(record['model'])})")
+                else:
+                    print(f"  failed {record['path']}: {record['error']}")
+        except TurnCancelled:
+            cancel.set()
+            print(f"Project cancelled after {len(results)} of {len(manifest)} files")
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        wall_time = time.time() - start_time
+        serial_time = sum(record["duration"] for record in results)
+        written = sum(1 for record in results if record["status"] == "ok")
+        print(f"Project: {written}/{len(results)} files in {wall_time:.2f}s "
+              f"(serial sum {serial_time:.2f}s, {serial_time / max(wall_time, 1e-9):.1f}x)")
+        return results
+
+    def _attach_path(self, filename):
+        return filename if os.path.isfile(filename) else self._full_path(filename)
+
+    def _map_chunk(self, name, question, chunk, model):
+        start_line, end_line, text, _ = chunk
+        prompt = f"""You are reading lines {start_line}-{end_line} of the file {name}.
+QUESTION: {question}
+Write short notes with every fact from this part that helps answer the question, citing line numbers.
+If nothing in this part is relevant, reply with only NONE.
+---
+{text}"""
+        messages = [{"role": "user", "content": prompt}]
+        max_tokens = self._pick_max_tokens("short", prompt, model, Conversation.estimate_tokens(messages[0]))
+        raw, _, _ = self._drive_completion(messages, max_tokens, 0.2, time.time(), model, stream=False)
+        notes = self.clean_thinking_text(raw).strip()
+        return start_line, end_line, None if notes.upper().rstrip(".") == "NONE" else notes
+
+    def _reduce_notes(self, name, question, notes, model, final=False):
+        joined = "\n\n".join(f"[lines {start}-{end}]\n{text}" for start, end, text in sorted(notes))
+        if final:
+            instruction = "Using only this material, give one complete answer to the question."
+        else:
+            instruction = "Merge these notes into one shorter set of notes, keeping every relevant fact and line number."
+        prompt = f"""The following notes and excerpts come from the file {name}.
+QUESTION: {question}
+{instruction}
+NOTES:
+{joined}"""
+        messages = [{"role": "user", "content": prompt}]
+        max_tokens = self._pick_max_tokens("chat", prompt, model, Conversation.estimate_tokens(messages[0]))
+        raw, _, _ = self._drive_completion(messages, max_tokens, 0.3, time.time(), model,
+                                           stream=self.stream if final else False)
+        text = self.clean_thinking_text(raw).strip()
+        return text if final else (min(start for start, _, _ in notes), max(end for _, end, _ in notes), text)
+
+    def attach(self, filename, question=None, concurrency=4):
+        if not self.get_api_key():
+            return None
+        path = self._attach_path(filename)
+        name = os.path.basename(path)
+        question = question or "Summarize this file: what it contains and anything notable in it."
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"Error reading file: {e}")
+            return None
+
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+        model = self.select_model()
+        budget = max(2000, (self.get_context_limit(model) - 1500) * 3)
+        start_time = time.time()
+        self.last_streamed = False
+        notes = []
+        notes_size = 0
+        chunks = 0
+        pending = set()
+        executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        try:
+            if size <= budget:
+                notes = [chunk[:3] for chunk in iter_line_chunks(path, budget)]
+                chunks = len(notes)
+            for chunk in iter_line_chunks(path, budget) if size > budget else ():
+                if len(pending) >= concurrency:
+                    done, pending = wait_cancellable(pending, FIRST_COMPLETED)
+                    for future in done:
+                        start, end, text = future.result()
+                        if text:
+                            notes.append((start, end, text))
+                            notes_size += len(text)
+                if notes_size > budget:
+                    notes = [self._reduce_notes(name, question, notes, model)]
+                    notes_size = len(notes[0][2])
+                pending.add(executor.submit(self._map_chunk, name, question, chunk, model))
+                chunks += 1
+                print(f"\rReading {name}: {chunk[3] * 100 // max(size, 1)}% ({chunks} chunks)", end="", flush=True)
+            for future in wait_cancellable(pending)[0]:
+                start, end, text = future.result()
+                if text:
+                    notes.append((start, end, text))
+                    notes_size += len(text)
+            if notes_size > budget:
+                notes = [self._reduce_notes(name, question, notes, model)]
+            if chunks > 1:
+                print(f"\rRead {name}: {chunks} chunks in {time.time() - start_time:.2f}s")
+            if not notes:
+                print(f"Nothing in {name} relates to the question")
+                return None
+            print("Thinking...", end="", flush=True)
+            answer = self._reduce_notes(name, question, notes, model, final=True)
+        except TurnCancelled:
+            raise
+        except APIError as e:
+            print(f"\rError reading {name}: {e}")
+            return None
+        except Exception as e:
+            print(f"\rError: {e}")
+            return None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        summary = (f"Answered from {name} ({size / (1024 * 1024):.1f} MB, {chunks} chunks) "
+                   f"in {time.time() - start_time:.2f}s{self._fallback_text(model)}")
+        if self.last_streamed:
+            print(summary)
+        else:
+            print(f"\r{summary}")
+            print(answer)
+        prompt = f"[attached {name}] {question}"
+        with self.stats_lock:
+            self.conversation.append({"role": "user", "content": prompt})
+            self.conversation.append({"role": "assistant", "content": answer})
+        self._journal({"type": "turn", "model": self.current_model, "answered_by": model,
+                       "user": prompt, "assistant": answer})
+        return answer
+
+    def open_session(self, name):
+        if SessionJournal(self._sessions_dir(), name).exists():
+            return self.resume_session(name)
+        self.start_session(name)
+        return True
+
+    def spawn_session(self):
+        self.http
+        self.router
+        self.rate_limiter
+        self.cache
+        session = CLIA.__new__(CLIA)
+        session.__dict__.update(self.__dict__)
+        session.conversation = Conversation()
+        session.request_tokens = []
+        session.session_start = datetime.now()
+        session.message_count = 0
+        session.model_usage = {}
+        session.compare_outcomes = {}
+        session.last_streamed = False
+        session.journal = None
+        session.jobs = {}
+        session.daemon_sessions = {}
+        return session
+
+    def _daemon_session(self, name):
+        with self.stats_lock:
+            entry = self.daemon_sessions.get(name)
+        if entry is None:
+            session = self.spawn_session()
+            with self.stats_lock:
+                entry = self.daemon_sessions.setdefault(name, (session, threading.Lock()))
+        return entry
+
+    def _handle_client(self, rfile, wfile):
+        cancel = threading.Event()
+        output = ClientOutput(wfile, cancel)
+        try:
+            request = json.loads(rfile.readline() or b"{}")
+        except ValueError:
+            output.send({"type": "error", "text": "invalid request"})
+            return
+        op = request.get("op")
+        with self.stats_lock:
+            self.daemon_requests[op] += 1
+            self.daemon_active += 1
+        sys.stdout.redirect(output)
+        try:
+            if op == "prompt":
+                name = request.get("session")
+                if name:
+                    session, lock = self._daemon_session(name)
+                else:
+                    session, lock = self.spawn_session(), threading.Lock()
+                with lock:
+                    if name and session.journal is None:
+                        session.open_session(name)
+                    if request.get("model") is not None:
+                        session.current_model = AUTO_MODEL if request["model"] == 0 else \
+                            session.resolve_model(request["model"])
+                    session.stream = bool(request.get("stream"))
+                    session.rag = bool(request.get("rag"))
+                    session.cache_mode = request.get("cache_mode", self.cache_mode)
+                    session.tier = request.get("tier", self.tier)
+                    session.max_retries = request.get("retries", self.max_retries)
+                    session.failover = request.get("failover", self.failover)
+                    session.max_continuations = request.get("max_continuations", self.max_continuations)
+                    session.hedge_after = request.get("hedge_after", self.hedge_after)
+                    label = f"daemon session {name}" if name else "daemon"
+                    print(f"Using {session.get_current_model_name()} ({label})")
+                    print("=" * 40)
+                    usage = Counter(session.model_usage)
+                    try:
+                        result = session.send_message(request.get("prompt", ""), cancel, cache=True)
+                    except TurnCancelled:
+                        result = None
+                    finally:
+                        with self.stats_lock:
+                            self.daemon_usage.update(Counter(session.model_usage) - usage)
+                output.send({"type": "result", "text": result, "streamed": session.last_streamed})
+            elif op == "stats":
+                self.show_daemon_stats()
+                output.send({"type": "result", "text": None})
+            elif op == "ping":
+                output.send({"type": "result", "text": "pong"})
+            else:
+                output.send({"type": "error", "text": f"unknown request {op!r}"})
+        except Exception as e:
+            output.send({"type": "error", "text": str(e)})
+        finally:
+            sys.stdout.redirect(None)
+            with self.stats_lock:
+                self.daemon_active -= 1
+
+    def show_daemon_stats(self):
+        uptime = str(datetime.now() - self.daemon_started).split('.')[0]
+        with self.stats_lock:
+            served = sum(self.daemon_requests.values())
+            requests_text = ", ".join(f"{count} {op}" for op, count in self.daemon_requests.most_common())
+            active = self.daemon_active
+            sessions = list(self.daemon_sessions.items())
+            usage = Counter(self.daemon_usage)
+        print("\nDaemon Statistics:")
+        print("=" * 30)
+        print(f"Uptime: {uptime} (pid {os.getpid()})")
+        print(f"Client requests: {served} ({requests_text}), {active} active")
+        print(f"Sessions: {len(sessions)}")
+        for name, (session, _) in sorted(sessions):
+            print(f"  {name}: {session.message_count} requests, {len(session.conversation)} messages "
+                  f"(~{session.conversation.total_tokens} tokens), {session.get_current_model_name()}")
+        self._show_transport_stats()
+        if usage:
+            print("\nModel Usage:")
+            for model, count in usage.most_common():
+                print(f"  {model}: {count} messages")
+        self._show_latency_stats()
+
+    def serve(self, socket_path=DAEMON_SOCKET):
+        import signal
+        import socketserver
+        if not self.ensure_api_key():
+            print("Cannot start the daemon without an API key")
+            return
+        if os.path.exists(socket_path):
+            if daemon_request(socket_path, {"op": "ping"}) is not None:
+                print(f"A daemon is already listening on {socket_path}")
+                return
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+
+        owner = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                owner._handle_client(self.rfile, self.wfile)
+
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        server.daemon_threads = True
+        os.chmod(socket_path, 0o600)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        self.daemon_started = datetime.now()
+        sys.stdout = ThreadLocalStdout(sys.stdout)
+        print(f"CLIA daemon listening on {socket_path} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nStopping daemon")
+        finally:
+            server.server_close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            for session, _ in self.daemon_sessions.values():
+                if session.journal is not None:
+                    session.journal.close()
+            sys.stdout = sys.stdout.default
+
     def single_prompt(self, prompt):
         if not self.ensure_api_key():
             print("Cannot process prompt without API key. Exiting...")
@@ -394,110 +3426,426 @@ Please generate the complete, working file content:"""
         current_model = self.get_current_model_name()
         print(f"Using {current_model}")
         print("=" * 40)
-        response = self.send_message(prompt)
-        print(response)
+        self.respond(prompt, cache=True)
 
-    def chat(self):
-        print("CLIA - Command Line Intelligent Assistant")
-        print("=" * 50)
-        print("Commands:")
+    def show_help(self):
+        print("\nCommands:")
         print("  help             - Show this help message")
         print("  models           - Show available models")
-        print("  switch [num]     - Switch to model number")
+        print("  switch [num]     - Switch to model number (0 or 'auto' routes by latency)")
         print("  stats            - Show session statistics")
         print("  save [filename]  - Save conversation")
         print("  clear            - Clear conversation")
+        print("  fork [name]      - Branch the conversation here, sharing its history")
+        print("  undo             - Drop the last exchange from the current branch")
+        print("  checkout [name]  - Switch branch (no name lists branches)")
+        print("  sessions         - List saved session journals")
+        print("  compact [name]   - Fold a session journal into one snapshot")
         print("  write <file>     - Create file manually")
-        print("  read <file>      - Read file")
+        print("  read <file>      - Read file (paged when large)")
+        print("  attach <file>    - Ask a question about a file of any size")
         print("  run <file>       - Run Python file")
+        print("  runs             - Show run history")
         print("  list             - List workspace files")
         print("  create           - AI assisted file creation")
+        print("  project          - Plan and generate a multi-file project")
+        print("  validate [k]     - Toggle trying k candidates per Python file in 'create'")
+        print("  jobs             - Show running and queued prompts")
+        print("  cancel [id|all]  - Cancel the running prompt (or Ctrl-C)")
+        print("  compare [all|race] [1,3,5] - Ask several models at once")
+        print("  stream           - Toggle streaming output")
+        print("  rag              - Toggle workspace context retrieval")
+        print("  index            - Update the workspace search index")
         print("  reset-key        - Reset API key")
         print("  quit             - Exit program")
-        print("=" * 50)
 
-        while True:
+    def _load_batch(self, input_path):
+        jobs = []
+        with open(input_path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    record = {"prompt": record}
+                if "prompt" not in record:
+                    raise ValueError(f"Line {line_number} has no 'prompt'")
+                record.setdefault("id", line_number)
+                jobs.append(record)
+        return jobs
+
+    @staticmethod
+    def _load_checkpoint(output_path):
+        done = set()
+        if not os.path.exists(output_path):
+            return done
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("error") is None:
+                    done.add(str(record.get("id")))
+        return done
+
+    def _run_batch_job(self, job, limiter):
+        start_time = time.time()
+        record = {"id": job["id"], "model": job.get("model"), "response": None, "error": None}
+        model = None
+        try:
+            model = record["model"] = self.resolve_model(job.get("model"))
+            limiter.wait(model)
+            start_time = time.time()
+            raw, _, record["model"] = self._complete(
+                [{"role": "user", "content": job["prompt"]}],
+                job.get("max_tokens", 1000), job.get("temperature", 0.7),
+                start_time, model=model, stream=False, cache=True)
+            record["response"] = self.clean_thinking_text(raw)
+        except Exception as e:
+            record["error"] = str(e)
+        record["latency"] = round(time.time() - start_time, 3)
+        if model is None:
+            return record
+        with self.stats_lock:
+            self.message_count += 1
+        self._record_usage(record["model"])
+        return record
+
+    def run_batch(self, input_path, output_path, concurrency=4, rate_limit=0, ordered=False):
+        if not self.ensure_api_key():
+            print("Cannot run batch without API key. Exiting...")
+            return
+        try:
+            jobs = self._load_batch(input_path)
+        except Exception as e:
+            print(f"Error reading batch file: {e}")
+            return
+
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        done = self._load_checkpoint(output_path)
+        pending = [job for job in jobs if str(job["id"]) not in done]
+        print(f"Batch: {len(jobs)} prompts, {len(jobs) - len(pending)} already done, "
+              f"{len(pending)} to run with concurrency {concurrency}")
+        if not pending:
+            return
+
+        limiter = RateLimiter(rate_limit)
+        latencies = []
+        errors = 0
+        held = {}
+        next_index = 0
+        start_time = time.time()
+
+        with open(output_path, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(self._run_batch_job, job, limiter): index
+                       for index, job in enumerate(pending)}
+            for future in as_completed(futures):
+                record = future.result()
+                latencies.append(record["latency"])
+                if record["error"] is not None:
+                    errors += 1
+
+                if ordered:
+                    held[futures[future]] = record
+                    while next_index in held:
+                        out.write(json.dumps(held.pop(next_index), ensure_ascii=False) + "\n")
+                        next_index += 1
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+
+                elapsed = time.time() - start_time
+                print(f"\r[{len(latencies)}/{len(pending)}] {len(latencies) / elapsed:.2f} prompts/s  "
+                      f"p50 {percentile(latencies, 0.5):.2f}s  p95 {percentile(latencies, 0.95):.2f}s  "
+                      f"errors {errors}", end="", flush=True)
+
+        elapsed = time.time() - start_time
+        print(f"\nBatch finished in {elapsed:.2f}s: {len(pending) - errors} succeeded, {errors} failed. "
+              f"Results in {output_path}")
+
+    def handle_command(self, user_input):
+        if user_input == 'help' or user_input.startswith('/help'):
+            self.show_help()
+        elif user_input == 'models' or user_input.startswith('/models'):
+            self.show_models()
+        elif user_input.startswith('switch') or user_input.startswith('/switch'):
+            parts = user_input.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                self.change_model(int(parts[1]))
+            elif len(parts) == 2 and parts[1].lower() == AUTO_MODEL:
+                self.change_model(0)
+            else:
+                self.change_model()
+        elif user_input == 'stats' or user_input.startswith('/stats'):
+            self.show_stats()
+        elif user_input.startswith('save') or user_input.startswith('/save'):
+            parts = user_input.split(maxsplit=1)
+            filename = parts[1] if len(parts) > 1 else None
+            self.save_conversation(filename)
+        elif user_input == 'clear' or user_input.startswith('/clear'):
+            if not self._conversation_busy("clear"):
+                self.clear_conversation()
+                print("Conversation cleared")
+        elif re.fullmatch(r'/?fork(?: \S+)?', user_input):
+            parts = user_input.split(maxsplit=1)
+            self.branch_conversation("fork", parts[1] if len(parts) > 1 else None)
+        elif user_input == 'undo' or user_input.startswith('/undo'):
+            self.branch_conversation("undo")
+        elif re.fullmatch(r'/?checkout(?: \S+)?', user_input):
+            parts = user_input.split(maxsplit=1)
+            if len(parts) > 1:
+                self.branch_conversation("checkout", parts[1])
+            else:
+                self.show_branches()
+        elif user_input.startswith('write') or user_input.startswith('/write'):
+            parts = user_input.split(maxsplit=1)
+            if len(parts) > 1:
+                self.write_file(parts[1])
+            else:
+                filename = input("Enter filename: ").strip()
+                if filename:
+                    self.write_file(filename)
+        elif user_input.startswith('read') or user_input.startswith('/read'):
+            parts = user_input.split(maxsplit=1)
+            if len(parts) > 1:
+                self.read_file(parts[1])
+            else:
+                filename = input("Enter filename: ").strip()
+                if filename:
+                    self.read_file(filename)
+        elif re.fullmatch(r'/?attach(?: \S+)?', user_input):
+            parts = user_input.split(maxsplit=1)
+            filename = parts[1] if len(parts) > 1 else input("Enter filename: ").strip()
+            if filename:
+                question = input("Question about the file (Enter to summarize): ").strip()
+                self.attach(filename, question or None, self.concurrency)
+        elif user_input == 'runs' or user_input.startswith('/runs'):
+            self.show_runs()
+        elif user_input.startswith('run') or user_input.startswith('/run'):
+            parts = user_input.split(maxsplit=1)
+            if len(parts) > 1:
+                self.run_file(parts[1])
+            else:
+                filename = input("Enter filename: ").strip()
+                if filename:
+                    self.run_file(filename)
+        elif user_input == 'list' or user_input.startswith('/list'):
+            self.list_files()
+        elif user_input == 'create' or user_input.startswith('/ai-create'):
+            description = input("Describe the file you want to create: ").strip()
+            if description:
+                self.ai_create_file(description)
+        elif re.fullmatch(r'/?validate(?: \d+)?', user_input):
+            parts = user_input.split()
+            if len(parts) > 1 and parts[1].isdigit():
+                self.validate_candidates = int(parts[1])
+            else:
+                self.validate_candidates = 0 if self.validate_candidates else 3
+            if self.validate_candidates:
+                print(f"Validated creation enabled: {self.validate_candidates} candidates, "
+                      f"{self.validate_timeout:g}s trial runs")
+            else:
+                print("Validated creation disabled")
+        elif user_input == 'reset-key' or user_input.startswith('/reset-key'):
+            self.reset_api_key()
+        elif user_input == 'sessions' or user_input.startswith('/sessions'):
+            self.list_sessions()
+        elif re.fullmatch(r'/?compact(?: \S+)?', user_input):
+            parts = user_input.split(maxsplit=1)
+            self.compact_session(parts[1] if len(parts) > 1 else None)
+        elif user_input == 'rag' or user_input.startswith('/rag'):
+            self.rag = not self.rag
+            print(f"Workspace context {'enabled' if self.rag else 'disabled'}")
+        elif user_input == 'index' or user_input.startswith('/index'):
+            self.rebuild_index()
+        elif user_input == 'project' or user_input.startswith('/project'):
+            description = input("Describe the project you want to create: ").strip()
+            if description:
+                self.create_project(description, self.assume_yes, self.concurrency)
+        elif re.fullmatch(r'/?compare(?: (?:all|race))?(?: (?:all|[\w.-]*[\d/][\w.,/-]*))?', user_input):
+            parts = user_input.split()[1:]
+            mode = parts.pop(0) if parts and parts[0] in ("all", "race") else self.compare_mode
             try:
-                current_model = self.get_current_model_name()
-                user_input = input(f"\n[{current_model}]: ").strip()
+                models = self.parse_model_selection(parts[0]) if parts else self.compare_models
+            except ValueError as e:
+                print(e)
+                return True
+            prompt = input("Prompt to compare: ").strip()
+            if prompt:
+                self.compare(prompt, models, mode)
+        elif user_input == 'stream' or user_input.startswith('/stream'):
+            self.stream = not self.stream
+            print(f"Streaming {'enabled' if self.stream else 'disabled'}")
+        else:
+            return False
+        return True
+
+    def chat(self):
+        print("CLIA - Command Line Intelligent Assistant")
+        print("=" * 50)
+        self.show_help()
+        print("=" * 50)
+        if self.journal is None:
+            self.start_session()
+        if self.run_options.get("workers"):
+            threading.Thread(target=self.run_engine.warm, daemon=True).start()
+
+        import asyncio
+        try:
+            asyncio.run(self._chat_loop())
+        except KeyboardInterrupt:
+            print("\nInterrupted. Goodbye.")
+
+    async def _chat_loop(self):
+        import asyncio
+        import signal
+        from concurrent.futures import ThreadPoolExecutor
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        consumer = asyncio.create_task(self._consume_prompts(queue))
+        console = ThreadPoolExecutor(max_workers=1)
+        try:
+            loop.add_signal_handler(signal.SIGINT, self._interrupt)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        try:
+            while True:
+                branch = self.conversation.branch
+                prompt = f"\n[{self.get_current_model_name()}{'' if branch == 'main' else ' @' + branch}]: "
+                try:
+                    user_input = (await loop.run_in_executor(console, input, prompt)).strip()
+                except EOFError:
+                    while self.jobs:
+                        await asyncio.sleep(0.05)
+                    print("Goodbye!")
+                    break
 
                 if not user_input:
                     continue
 
+                parts = user_input.split()
                 if user_input.lower() in ['quit', 'exit', 'q']:
+                    if self.jobs:
+                        print(f"Cancelling {len(self.jobs)} unfinished job{'s' if len(self.jobs) > 1 else ''}:")
+                        self.show_jobs()
                     print("Goodbye!")
                     break
-                elif user_input == 'help' or user_input.startswith('/help'):
-                    print("\nCommands:")
-                    print("  help             - Show this help message")
-                    print("  models           - Show available models")
-                    print("  switch [num]     - Switch to model number")
-                    print("  stats            - Show session statistics")
-                    print("  save [filename]  - Save conversation")
-                    print("  clear            - Clear conversation")
-                    print("  write <file>     - Create file manually")
-                    print("  read <file>      - Read file")
-                    print("  run <file>       - Run Python file")
-                    print("  list             - List workspace files")
-                    print("  create           - AI assisted file creation")
-                    print("  reset-key        - Reset API key")
-                    print("  quit             - Exit program")
-                elif user_input == 'models' or user_input.startswith('/models'):
-                    self.show_models()
-                elif user_input.startswith('switch') or user_input.startswith('/switch'):
-                    parts = user_input.split()
-                    if len(parts) == 2 and parts[1].isdigit():
-                        self.change_model(int(parts[1]))
-                    else:
-                        self.change_model()
-                elif user_input == 'stats' or user_input.startswith('/stats'):
-                    self.show_stats()
-                elif user_input.startswith('save') or user_input.startswith('/save'):
-                    parts = user_input.split(maxsplit=1)
-                    filename = parts[1] if len(parts) > 1 else None
-                    self.save_conversation(filename)
-                elif user_input == 'clear' or user_input.startswith('/clear'):
-                    self.conversation = []
-                    print("Conversation cleared")
-                elif user_input.startswith('write') or user_input.startswith('/write'):
-                    parts = user_input.split(maxsplit=1)
-                    if len(parts) > 1:
-                        self.write_file(parts[1])
-                    else:
-                        filename = input("Enter filename: ").strip()
-                        if filename:
-                            self.write_file(filename)
-                elif user_input.startswith('read') or user_input.startswith('/read'):
-                    parts = user_input.split(maxsplit=1)
-                    if len(parts) > 1:
-                        self.read_file(parts[1])
-                    else:
-                        filename = input("Enter filename: ").strip()
-                        if filename:
-                            self.read_file(filename)
-                elif user_input.startswith('run') or user_input.startswith('/run'):
-                    parts = user_input.split(maxsplit=1)
-                    if len(parts) > 1:
-                        self.run_file(parts[1])
-                    else:
-                        filename = input("Enter filename: ").strip()
-                        if filename:
-                            self.run_file(filename)
-                elif user_input == 'list' or user_input.startswith('/list'):
-                    self.list_files()
-                elif user_input == 'create' or user_input.startswith('/ai-create'):
-                    description = input("Describe the file you want to create: ").strip()
-                    if description:
-                        self.ai_create_file(description)
-                elif user_input == 'reset-key' or user_input.startswith('/reset-key'):
-                    self.reset_api_key()
-                else:
-                    response = self.send_message(user_input)
+                elif user_input == 'jobs' or user_input.startswith('/jobs'):
+                    self.show_jobs()
+                elif parts[0] in ('cancel', '/cancel') and len(parts) <= 2:
+                    self.cancel_jobs(parts[1] if len(parts) > 1 else None)
+                elif not await loop.run_in_executor(console, self._run_console_command, user_input):
+                    self.job_counter += 1
+                    job = ChatJob(self.job_counter, user_input)
+                    if self.jobs:
+                        print(f"Queued as job {job.id}")
+                    self.jobs[job.id] = job
+                    queue.put_nowait(job)
+        finally:
+            consumer.cancel()
+            for job in self.jobs.values():
+                job.cancel.set()
+            self.jobs.clear()
+            console.shutdown(wait=False)
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    async def _consume_prompts(self, queue):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await queue.get()
+            if job.cancel.is_set():
+                continue
+            job.started = time.time()
+            job.done = loop.create_future()
+            threading.Thread(target=self._run_job, args=(loop, job), daemon=True).start()
+            try:
+                response = await job.done
+                if not self.last_streamed:
                     print(response)
+            except TurnCancelled:
+                print(f"\nCancelled job {job.id}")
+            finally:
+                self.jobs.pop(job.id, None)
 
-            except KeyboardInterrupt:
-                print("\nInterrupted. Goodbye.")
-                break
+    def _run_job(self, loop, job):
+        try:
+            outcome = (self.send_message(job.prompt, job.cancel), None)
+        except TurnCancelled as e:
+            outcome = (None, e)
+        try:
+            loop.call_soon_threadsafe(self._settle_job, job, *outcome)
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    def _settle_job(job, result, error):
+        if job.done.done():
+            return
+        if error is not None:
+            job.done.set_exception(error)
+        else:
+            job.done.set_result(result)
+
+    def _run_console_command(self, user_input):
+        self.console_cancel = _turn_state.cancel = threading.Event()
+        try:
+            return self.handle_command(user_input)
+        except TurnCancelled:
+            print("\nCancelled")
+            return True
+        finally:
+            self.console_cancel = _turn_state.cancel = None
+
+    def _interrupt(self):
+        if self.console_cancel is not None:
+            self.console_cancel.set()
+            if self._run_engine is not None:
+                self._run_engine.cancel()
+        elif any(job.started for job in self.jobs.values()):
+            self.cancel_jobs()
+        else:
+            print("\nNothing running (type 'quit' to exit)")
+
+    def show_jobs(self):
+        if not self.jobs:
+            print("No jobs")
+            return
+        now = time.time()
+        for job in self.jobs.values():
+            state = f"running {now - job.started:.1f}s" if job.started else "queued"
+            prompt = job.prompt if len(job.prompt) <= 50 else job.prompt[:47] + "..."
+            print(f"  {job.id:>3}  {state:<14} {prompt}")
+
+    def cancel_jobs(self, target=None):
+        if target == "all":
+            jobs = list(self.jobs.values())
+        elif target is None:
+            jobs = [job for job in self.jobs.values() if job.started][:1]
+        elif target.isdigit() and int(target) in self.jobs:
+            jobs = [self.jobs[int(target)]]
+        else:
+            print(f"No job {target}")
+            return
+        if not jobs:
+            print("No jobs running")
+            return
+
+        for job in jobs:
+            with self.stats_lock:
+                job.cancel.set()
+            if job.done is not None:
+                self._settle_job(job, None, TurnCancelled("turn cancelled"))
+            else:
+                self.jobs.pop(job.id, None)
+                print(f"Removed queued job {job.id}")
 
     def res(self, prompt):
         if not self.ensure_api_key():
@@ -506,13 +3854,10 @@ Please generate the complete, working file content:"""
         current_model = self.get_current_model_name()
         print(f"Using {current_model}")
         print("=" * 40)
-        response = self.send_message(prompt)
-        print(response)
+        self.respond(prompt, cache=True)
 
 
 def main():
-    client = CLIA()
-
     parser = argparse.ArgumentParser(
         description="CLIA - Command Line Intelligent Assistant",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -521,30 +3866,210 @@ Examples:
   python ai.py                   # Start interactive chat
   python ai.py -p "Hello world"  # Single prompt mode
   python ai.py -m 2 -p "Hello"   # Use specific model
+  python ai.py -m 0 --tier 2     # Route to the fastest healthy tier-2+ model
   python ai.py --list-models     # List models
+  python ai.py -s -p "Hello"     # Stream the response
+  python ai.py --models 1,3,5 --compare-mode race -p "Hello"
+  python ai.py --batch prompts.jsonl --out results.jsonl --concurrency 8
+  python ai.py --project "Flask todo app" --yes --concurrency 6
+  python ai.py --attach server.log -p "Which errors occur most often?"
+  python ai.py --daemon &        # Keep a warm instance; later -p calls go through it
+  python ai.py --session work -p "Continue"
         """
     )
     parser.add_argument("-p", "--prompt", help="Single prompt mode")
-    parser.add_argument("-m", "--model", type=int, choices=range(1, len(client.models) + 1),
-                       help=f"Select model (1-{len(client.models)})")
+    parser.add_argument("-m", "--model", type=int, choices=range(0, len(MODELS) + 1),
+                       help=f"Select model (1-{len(MODELS)}, 0 routes automatically)")
+    parser.add_argument("--tier", type=int, choices=[1, 2, 3], default=1,
+                       help="Minimum quality tier for automatic routing (default: 1)")
+    parser.add_argument("--explore", type=float, default=0.1,
+                       help="Share of automatically routed requests sent to a random model (default: 0.1)")
     parser.add_argument("--list-models", action="store_true",
                        help="List all available models and exit")
+    parser.add_argument("--models", metavar="LIST",
+                       help="Ask several models at once, e.g. 1,3,5 or all (used by -p and 'compare')")
+    parser.add_argument("--compare-mode", choices=["all", "race"], default="all",
+                       help="'all' shows every answer, 'race' keeps the first and cancels the rest")
+    parser.add_argument("-s", "--stream", action="store_true",
+                       help="Stream tokens as they are generated")
+    parser.add_argument("--rag", action="store_true",
+                       help="Add the most relevant workspace file chunks to each prompt")
+    parser.add_argument("--pool-size", type=int, default=10,
+                       help="Maximum pooled HTTP connections (default: 10)")
+    parser.add_argument("--connect-timeout", type=float, default=10.0,
+                       help="Seconds to wait for a connection (default: 10)")
+    parser.add_argument("--read-timeout", type=float, default=300.0,
+                       help="Seconds to wait for response data (default: 300)")
+    parser.add_argument("--retries", type=int, default=3,
+                       help="Retries per model on 429/5xx/connection errors (default: 3)")
+    parser.add_argument("--no-failover", action="store_true",
+                       help="Do not fall back to other models when the selected one fails")
+    parser.add_argument("--max-continuations", type=int, default=3,
+                       help="Follow-up requests to finish a reply cut off at max_tokens (default: 3, 0 to disable)")
+    parser.add_argument("--hedge-after", type=float, metavar="SEC",
+                       help="Send a duplicate request if no response after SEC seconds (non-streaming)")
+    parser.add_argument("--project", metavar="DESCRIPTION",
+                       help="Plan a multi-file project, generate its files concurrently and exit")
+    parser.add_argument("--attach", metavar="FILE",
+                       help="Answer -p (or summarize) from a file of any size by reading it in chunks, then exit")
+    parser.add_argument("--validate", type=int, default=0, metavar="K",
+                       help="'create' generates K Python candidates concurrently and keeps the first that compiles "
+                            "and runs (default: off)")
+    parser.add_argument("--validate-timeout", type=float, default=10.0,
+                       help="Seconds a candidate may run before it counts as working (default: 10)")
+    parser.add_argument("-y", "--yes", action="store_true",
+                       help="Do not ask for confirmation (project generation)")
+    parser.add_argument("--batch", metavar="FILE",
+                       help="Run every prompt in a JSONL file and exit")
+    parser.add_argument("--out", metavar="FILE",
+                       help="JSONL file for batch results (default: <batch>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                       help="Concurrent requests in batch, project and attach mode (default: 4)")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                       help="Maximum requests per minute per model in batch mode (default: unlimited)")
+    parser.add_argument("--rpm", type=float, default=0,
+                       help="Requests per minute shared by every CLIA process using this API key "
+                            "(default: learned from API rate-limit headers)")
+    parser.add_argument("--tpm", type=float, default=0,
+                       help="Tokens per minute shared the same way (default: learned from API rate-limit headers)")
+    parser.add_argument("--ordered", action="store_true",
+                       help="Write batch results in input order instead of completion order")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument("--no-cache", action="store_true",
+                             help="Bypass the response cache")
+    cache_group.add_argument("--cache-only", action="store_true",
+                             help="Serve responses from the cache only, never call the API")
+    cache_group.add_argument("--cache-all", action="store_true",
+                             help="Also cache sampled replies (interactive chat, compare)")
+    parser.add_argument("--cache-size", type=float, default=50,
+                       help="Response cache size cap in MB (default: 50)")
+    parser.add_argument("--cache-ttl", type=float, default=168,
+                       help="Response cache entry lifetime in hours (default: 168)")
+    parser.add_argument("--run-timeout", type=float, default=60.0,
+                       help="Wall-clock limit in seconds for 'run' (default: 60, 0 for none)")
+    parser.add_argument("--run-memory", type=float, default=512,
+                       help="Address-space limit in MB for 'run' (default: 512, 0 for none)")
+    parser.add_argument("--run-workers", type=int, default=0,
+                       help="Pre-warmed Python workers kept ready for 'run' (default: 0)")
+    parser.add_argument("--metrics-out", metavar="FILE",
+                       help="Write per-request metrics as JSONL, or Prometheus text if FILE ends in .prom")
+    parser.add_argument("--resume", metavar="SESSION",
+                       help="Resume a journaled session")
+    parser.add_argument("--compact", metavar="SESSION",
+                       help="Fold a session journal into a single snapshot and exit")
+    parser.add_argument("--daemon", action="store_true",
+                       help="Keep a warm CLIA running and serve -p requests over a Unix socket")
+    parser.add_argument("--socket", default=DAEMON_SOCKET,
+                       help=f"Daemon socket path (default: {DAEMON_SOCKET})")
+    parser.add_argument("--session", metavar="NAME",
+                       help="Conversation to continue with -p (kept by the daemon, or journaled locally)")
+    parser.add_argument("--no-daemon", action="store_true",
+                       help="Answer -p in this process even if a daemon is running")
+    parser.add_argument("--daemon-stats", action="store_true",
+                       help="Show the running daemon's uptime and request statistics and exit")
+    parser.add_argument("--profile-startup", action="store_true",
+                       help="Report import time per module and exit")
 
     args = parser.parse_args()
 
     if args.list_models:
-        client.show_models()
+        print_models()
         return
+    if args.profile_startup:
+        profile_startup()
+        return
+    if args.daemon_stats:
+        if daemon_request(args.socket, {"op": "stats"}) is None:
+            print(f"No daemon listening on {args.socket}")
+        return
+    local_options = ("resume", "metrics_out", "explore", "pool_size", "connect_timeout", "read_timeout", "rpm", "tpm",
+                     "cache_size", "cache_ttl")
+    if args.prompt and not (args.no_daemon or args.daemon or args.batch or args.project or args.models
+                            or args.attach or any(getattr(args, name) != parser.get_default(name)
+                                                  for name in local_options)):
+        result = daemon_request(args.socket, {
+            "op": "prompt", "prompt": args.prompt, "session": args.session, "model": args.model,
+            "stream": args.stream, "rag": args.rag, "tier": args.tier, "retries": max(0, args.retries),
+            "failover": not args.no_failover, "max_continuations": max(0, args.max_continuations),
+            "hedge_after": args.hedge_after,
+            "cache_mode": "off" if args.no_cache else "only" if args.cache_only else "all" if args.cache_all else "on"
+        })
+        if result is not None:
+            if result["type"] == "error":
+                print(f"Error: {result['text']}")
+            elif result.get("text") and not result.get("streamed"):
+                print(result["text"])
+            return
 
-    if args.model:
+    client = CLIA()
+    if args.model == 0:
+        client.current_model = AUTO_MODEL
+        print(f"Using automatic routing (tier {args.tier}+)")
+    elif args.model:
         client.current_model = client.models[args.model - 1][1]
         model_name = client.models[args.model - 1][0]
         print(f"Using {model_name}")
+    client.tier = args.tier
+    client.router_options = {"explore": min(max(args.explore, 0.0), 1.0)}
 
-    if args.prompt:
-        client.single_prompt(args.prompt)
-    else:
-        client.chat()
+    client.stream = args.stream
+    client.rag = args.rag
+    client.compare_mode = args.compare_mode
+    client.assume_yes = args.yes
+    client.concurrency = max(1, args.concurrency)
+    client.validate_candidates = max(0, args.validate)
+    client.validate_timeout = args.validate_timeout
+    if args.models:
+        try:
+            client.compare_models = client.parse_model_selection(args.models)
+        except ValueError as e:
+            print(e)
+            return
+    client.metrics.path = args.metrics_out
+    client.run_options = {"workers": max(0, args.run_workers), "timeout": args.run_timeout,
+                          "memory_limit_mb": args.run_memory}
+    client.http_options = {
+        "pool_size": max(args.pool_size, args.concurrency) if args.batch or args.project or args.attach else args.pool_size,
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout
+    }
+    client.rate_limit_options = {"requests_per_minute": max(0.0, args.rpm), "tokens_per_minute": max(0.0, args.tpm)}
+    client.max_retries = max(0, args.retries)
+    client.failover = not args.no_failover
+    client.hedge_after = args.hedge_after
+    client.max_continuations = max(0, args.max_continuations)
+    client.cache_mode = "off" if args.no_cache else "only" if args.cache_only else "all" if args.cache_all else "on"
+    client.cache_options = {"max_bytes": int(args.cache_size * 1024 * 1024), "ttl": args.cache_ttl * 3600}
+
+    if args.compact:
+        client.compact_session(args.compact)
+        return
+    if args.resume and not client.resume_session(args.resume):
+        return
+
+    try:
+        if args.daemon:
+            client.serve(args.socket)
+        elif args.batch:
+            output_path = args.out or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+            client.run_batch(args.batch, output_path, max(1, args.concurrency), args.rate_limit, args.ordered)
+        elif args.project:
+            if client.ensure_api_key():
+                client.create_project(args.project, client.assume_yes, client.concurrency)
+        elif args.attach:
+            if client.ensure_api_key():
+                client.attach(args.attach, args.prompt, client.concurrency)
+        elif args.prompt and client.compare_models:
+            if client.ensure_api_key():
+                client.compare(args.prompt, client.compare_models, client.compare_mode)
+        elif args.prompt:
+            if args.session and not client.open_session(args.session):
+                return
+            client.single_prompt(args.prompt)
+        else:
+            client.chat()
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,424 @@
+import argparse
+import contextlib
+import gc
+import glob
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ai import CLIA, Conversation, HTTPClient, WorkspaceIndex
+from mock_server import MockConfig, make_reply, make_server
+
+
+def start_mock_server(config=None):
+    server = make_server(config=config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1/chat/completions"
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000
+    }
+
+
+def bench_pool(args):
+    server, url = start_mock_server(MockConfig(reply="ok"))
+    payload = {"model": "mock", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 16}
+    headers = {"Authorization": "Bearer bench", "Content-Type": "application/json"}
+
+    unpooled = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        requests.post(url, headers=headers, json=payload).json()
+        unpooled.append(time.perf_counter() - start)
+
+    client = HTTPClient(pool_size=args.pool_size)
+    client.authorize("bench")
+    pooled = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        client.post(url, payload).json()
+        pooled.append(time.perf_counter() - start)
+
+    result = {
+        "benchmark": "pool",
+        "unpooled": summarize(unpooled),
+        "pooled": summarize(pooled),
+        "connection_stats": client.stats()
+    }
+    client.close()
+    server.shutdown()
+    return result
+
+
+def make_synthetic_workspace(root, files, lines_per_file=60, seed=7):
+    rng = random.Random(seed)
+    vocabulary = [f"{prefix}_{n}" for prefix in ("user", "order", "cache", "parse", "render", "socket")
+                  for n in range(400)]
+    for number in range(files):
+        directory = os.path.join(root, f"pkg{number % 50}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"module{number}.py"), "w", encoding="utf-8") as f:
+            for line in range(lines_per_file):
+                words = " ".join(rng.choice(vocabulary) for _ in range(6))
+                f.write(f"def func_{number}_{line}(): return '{words}'\n")
+    return vocabulary
+
+
+def bench_index(args):
+    with tempfile.TemporaryDirectory() as root:
+        workspace = os.path.join(root, "workspace")
+        vocabulary = make_synthetic_workspace(workspace, args.files)
+        index_path = os.path.join(workspace, ".clia", "index.json")
+
+        start = time.perf_counter()
+        index = WorkspaceIndex(workspace, index_path)
+        index.refresh()
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        index.save()
+        save = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = WorkspaceIndex(workspace, index_path)
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.refresh()
+        noop_refresh = time.perf_counter() - start
+
+        for number in range(args.changed):
+            path = os.path.join(workspace, f"pkg{number % 50}", f"module{number}.py")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("def added(): return 'incremental_update'\n")
+        start = time.perf_counter()
+        changed = index.refresh()
+        incremental_refresh = time.perf_counter() - start
+
+        rng = random.Random(11)
+        latencies = []
+        for _ in range(args.queries):
+            query = " ".join(rng.choice(vocabulary) for _ in range(3))
+            start = time.perf_counter()
+            index.query(query, 3)
+            latencies.append(time.perf_counter() - start)
+
+        return {
+            "benchmark": "index",
+            "files": len(index.files),
+            "chunks": len(index.chunks),
+            "index_bytes": os.path.getsize(index_path),
+            "build_s": build,
+            "save_s": save,
+            "load_s": load,
+            "noop_refresh_s": noop_refresh,
+            "incremental_refresh_s": incremental_refresh,
+            "incremental_files": changed,
+            "query": summarize(latencies)
+        }
+
+
+@contextlib.contextmanager
+def quiet_workspace():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as root, open(os.devnull, "w") as devnull:
+        os.chdir(root)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                yield root
+        finally:
+            os.chdir(previous)
+
+
+def make_client(url, **attributes):
+    client = CLIA()
+    client.api_key = "bench"
+    client.api_url = url
+    client.cache_mode = "off"
+    for name, value in attributes.items():
+        setattr(client, name, value)
+    return client
+
+
+def timed_turns(client, prompts):
+    latencies = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        result = client.send_message(prompt)
+        latencies.append(time.perf_counter() - start)
+        if result.startswith("Error:"):
+            raise RuntimeError(result)
+    return latencies
+
+
+def bench_overhead(args):
+    server, url = start_mock_server(MockConfig(reply=make_reply(args.reply_size), chunk_size=args.chunk_size))
+    payload = {"model": "mock", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 1000}
+    result = {"benchmark": "overhead", "reply_chars": len(server.RequestHandlerClass.config.reply)}
+
+    client = HTTPClient()
+    client.authorize("bench")
+    for mode, stream in (("buffered", False), ("streamed", True)):
+        raw = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            response = client.post(url, dict(payload, stream=stream), stream=stream)
+            for _ in response.iter_lines(chunk_size=None):
+                pass
+            raw.append(time.perf_counter() - start)
+
+        with quiet_workspace():
+            cli = make_client(url, stream=stream)
+            turns = timed_turns(cli, [f"turn {n}" for n in range(args.requests)])
+            cli.close()
+
+        raw_summary, turn_summary = summarize(raw), summarize(turns)
+        result[mode] = {
+            "http": raw_summary,
+            "turn": turn_summary,
+            "overhead_ms": turn_summary["mean_ms"] - raw_summary["mean_ms"]
+        }
+    client.close()
+    server.shutdown()
+    return result
+
+
+def bench_throughput(args):
+    config = MockConfig(reply=make_reply(args.reply_size), latency=args.latency, chunk_size=args.chunk_size)
+    server, url = start_mock_server(config)
+    result = {"benchmark": "throughput", "latency_s": args.latency, "turns_per_session": args.turns, "runs": []}
+
+    for sessions in args.sessions:
+        with quiet_workspace():
+            clients = [make_client(url, stream=args.stream) for _ in range(sessions)]
+            with ThreadPoolExecutor(max_workers=sessions) as executor:
+                start = time.perf_counter()
+                futures = [executor.submit(timed_turns, client, [f"turn {n}" for n in range(args.turns)])
+                           for client in clients]
+                latencies = [sample for future in futures for sample in future.result()]
+                elapsed = time.perf_counter() - start
+            for client in clients:
+                client.close()
+        result["runs"].append({
+            "sessions": sessions,
+            "turns": len(latencies),
+            "elapsed_s": elapsed,
+            "turns_per_s": len(latencies) / elapsed,
+            "turn": summarize(latencies)
+        })
+    server.shutdown()
+    return result
+
+
+def make_reasoning_text(size, seed=3):
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "<b>", "x < y", "gamma\n", "delta", "</i>", "epsilon"]
+    parts = []
+    total = 0
+    while total < size:
+        think = " ".join(rng.choice(words) for _ in range(rng.randint(200, 2000)))
+        answer = " ".join(rng.choice(words) for _ in range(rng.randint(50, 500)))
+        block = f"<think>{think}</think>\n\n\n{answer}\n"
+        parts.append(block)
+        total += len(block)
+    return "".join(parts)
+
+
+def bench_clean(args):
+    result = {"benchmark": "clean", "chunk_size": args.chunk_size, "runs": []}
+    for megabytes in args.clean_mb:
+        text = make_reasoning_text(int(megabytes * 1024 * 1024))
+        start = time.perf_counter()
+        CLIA.clean_thinking_text(text)
+        batch = time.perf_counter() - start
+
+        chunks = [text[i:i + args.chunk_size] for i in range(0, len(text), args.chunk_size)]
+        start = time.perf_counter()
+        for _ in CLIA.clean_thinking_stream(chunks):
+            pass
+        streamed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in CLIA.clean_thinking_stream([text]):
+            pass
+        single_chunk = time.perf_counter() - start
+
+        size = len(text) / (1024 * 1024)
+        result["runs"].append({
+            "megabytes": size,
+            "batch_s": batch,
+            "batch_mb_per_s": size / batch,
+            "stream_s": streamed,
+            "stream_mb_per_s": size / streamed,
+            "single_chunk_s": single_chunk
+        })
+    return result
+
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    messages = Conversation.load(data).to_list()
+    return ([m["content"] for m in messages if m.get("role") == "user"],
+            [m["content"] for m in messages if m.get("role") == "assistant"])
+
+
+def bench_replay(args):
+    paths = [os.path.abspath(path) for pattern in args.trace for path in glob.glob(pattern)]
+    traces = [(os.path.basename(path),) + load_trace(path) for path in paths]
+    if not traces:
+        prompts = [f"Question {n}: " + "explain the previous answer in more detail " * 8 for n in range(args.turns)]
+        traces = [("synthetic", prompts, [make_reply(args.reply_size)])]
+
+    result = {"benchmark": "replay", "traces": []}
+    for name, prompts, replies in traces:
+        reply_size = int(statistics.mean(len(reply) for reply in replies)) if replies else args.reply_size
+        server, url = start_mock_server(MockConfig(reply=make_reply(reply_size), latency=args.latency,
+                                                   chunk_size=args.chunk_size))
+        with quiet_workspace():
+            client = make_client(url, stream=args.stream)
+            latencies = timed_turns(client, prompts)
+            client.close()
+        tokens = [sent for sent, _ in client.request_tokens]
+        dropped = sum(dropped for _, dropped in client.request_tokens)
+        server.shutdown()
+        result["traces"].append({
+            "trace": name,
+            "turns": len(prompts),
+            "reply_chars": reply_size,
+            "turn": summarize(latencies),
+            "first_turn_ms": latencies[0] * 1000 if latencies else None,
+            "last_turn_ms": latencies[-1] * 1000 if latencies else None,
+            "tokens_sent_max": max(tokens, default=0),
+            "messages_dropped": dropped
+        })
+    return result
+
+
+def traced(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0], kept
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    result = {"benchmark": "memory", "forks": args.forks, "runs": []}
+    reply = make_reply(args.reply_size)
+    for turns in args.history_turns:
+        history = []
+        for n in range(turns):
+            history.append({"role": "user", "content": f"Question {n}: explain the previous answer in more detail"})
+            history.append({"role": "assistant", "content": f"Answer {n}: {reply}"})
+        text = json.dumps(history)
+        follow_ups = [[{"role": "user", "content": f"Follow-up {n}"}, {"role": "assistant", "content": f"Reply {n}"}]
+                      for n in range(args.forks)]
+        content_bytes = sum(sys.getsizeof(message["content"]) for message in history)
+
+        def flat():
+            messages = json.loads(text)
+            tokens = [Conversation.estimate_tokens(message) for message in messages]
+            branches = [list(messages) + [dict(message) for message in pair] for pair in follow_ups]
+            return messages, tokens, branches
+
+        def tree():
+            conversation = Conversation(json.loads(text))
+            for pair in follow_ups:
+                conversation.checkout("main")
+                conversation.fork()
+                for message in pair:
+                    conversation.append(message)
+            return conversation
+
+        flat_bytes, (messages, _, branches) = traced(flat)
+        tree_bytes, conversation = traced(tree)
+        flat_json = sum(len(json.dumps({"conversation": branch})) for branch in branches)
+        tree_json = len(json.dumps({"tree": conversation.to_tree()}))
+        result["runs"].append({
+            "turns": turns,
+            "messages": len(messages),
+            "content_bytes": content_bytes,
+            "flat_bytes": flat_bytes,
+            "tree_bytes": tree_bytes,
+            "flat_overhead_per_message": (flat_bytes - content_bytes) / len(messages),
+            "tree_overhead_per_message": (tree_bytes - content_bytes) / len(messages),
+            "flat_saved_bytes": flat_json,
+            "tree_saved_bytes": tree_json
+        })
+    return result
+
+
+BENCHMARKS = {
+    "pool": bench_pool,
+    "index": bench_index,
+    "overhead": bench_overhead,
+    "throughput": bench_throughput,
+    "clean": bench_clean,
+    "replay": bench_replay,
+    "memory": bench_memory,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLIA benchmarks against a local mock endpoint")
+    parser.add_argument("benchmark", nargs="+", choices=sorted(BENCHMARKS) + ["all"], help="Benchmarks to run")
+    parser.add_argument("--output", help="Write machine-readable results to this JSON file")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per measurement")
+    parser.add_argument("--pool-size", type=int, default=10, help="HTTP pool size for pooled runs")
+    parser.add_argument("--files", type=int, default=10000, help="Synthetic workspace size for index runs")
+    parser.add_argument("--changed", type=int, default=20, help="Files modified before the incremental refresh")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per index run")
+    parser.add_argument("--reply-size", type=int, default=2000, help="Characters in each mock reply")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Characters per streamed chunk")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock latency for throughput and replay runs")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16], help="Concurrent sessions to measure")
+    parser.add_argument("--turns", type=int, default=10, help="Turns per session")
+    parser.add_argument("--stream", action="store_true", help="Stream responses in client runs")
+    parser.add_argument("--clean-mb", type=float, nargs="+", default=[1, 4, 16], help="Reasoning output sizes in MB")
+    parser.add_argument("--history-turns", type=int, nargs="+", default=[1000, 5000],
+                        help="Conversation lengths for memory runs")
+    parser.add_argument("--forks", type=int, default=8, help="Branches forked from the end of each memory run")
+    parser.add_argument("--trace", nargs="+", default=["conversation_*.json"], help="Saved conversations to replay")
+    args = parser.parse_args()
+
+    names = sorted(BENCHMARKS) if "all" in args.benchmark else args.benchmark
+    results = []
+    for name in names:
+        results.append(BENCHMARKS[name](args))
+        print(json.dumps(results[-1], indent=2))
+
+    if args.output:
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "arguments": vars(args),
+            "results": results
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
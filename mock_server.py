@@ -0,0 +1,238 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_REPLY = "<think>Working out a reply.</think>\n\nHello from the local CLIA mock server."
+
+
+def make_reply(size, think_ratio=0.5):
+    think_size = int(size * think_ratio)
+    filler = "The quick brown fox jumps over the lazy dog. "
+    think = (filler * (think_size // len(filler) + 1))[:think_size]
+    answer_size = max(1, size - think_size)
+    answer = (filler * (answer_size // len(filler) + 1))[:answer_size]
+    return f"<think>{think}</think>\n\n{answer}" if think_size else answer
+
+
+class MockConfig:
+    def __init__(self, reply=DEFAULT_REPLY, latency=0.0, chunk_delay=0.0, chunk_size=4,
+                 latency_jitter=0.0, fail_rate=0.0, fail_status=503, retry_after=None, fail_models=(), routes=None,
+                 model_latency=None, rpm=0, temperature_replies=None, honor_max_tokens=False, fail_first=0):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.latency_jitter = latency_jitter
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.fail_models = set(fail_models)
+        self.routes = dict(routes or {})
+        self.model_latency = dict(model_latency or {})
+        self.rpm = rpm
+        self.temperature_replies = dict(temperature_replies or {})
+        self.honor_max_tokens = honor_max_tokens
+        self.fail_first = fail_first
+        self.window = []
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.received = 0
+
+    def should_fail(self, model):
+        with self.lock:
+            self.received += 1
+            if self.received <= self.fail_first:
+                return True
+        return model in self.fail_models or random.random() < self.fail_rate
+
+    def truncate(self, reply, messages, max_tokens):
+        if len(messages) >= 2 and messages[-2].get("role") == "assistant":
+            tail = str(messages[-2].get("content", ""))[-40:]
+            position = reply.find(tail) if tail else -1
+            if position != -1:
+                reply = reply[position + len(tail):]
+        limit = max(1, int(max_tokens or 0) * 4)
+        if len(reply) > limit:
+            return reply[:limit], "length"
+        return reply, "stop"
+
+    def admit(self):
+        if not self.rpm:
+            return True, {}
+        with self.lock:
+            now = time.time()
+            self.window = [stamp for stamp in self.window if stamp > now - 60]
+            admitted = len(self.window) < self.rpm
+            if admitted:
+                self.window.append(now)
+            else:
+                self.throttled += 1
+            reset = self.window[0] + 60 - now if self.window else 0.0
+            return admitted, {
+                "x-ratelimit-limit-requests": str(self.rpm),
+                "x-ratelimit-remaining-requests": str(self.rpm - len(self.window)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s"
+            }
+
+    def reply_for(self, messages, temperature=None):
+        if temperature in self.temperature_replies:
+            return self.temperature_replies[temperature]
+        prompt = str(messages[-1].get("content", "")) if messages else ""
+        return next((reply for key, reply in self.routes.items() if key in prompt), self.reply)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON body"}})
+            return
+
+        latency = self.config.model_latency.get(payload.get("model"), self.config.latency)
+        time.sleep(latency + random.uniform(0, self.config.latency_jitter))
+        if self.config.should_fail(payload.get("model")):
+            headers = {}
+            if self.config.retry_after is not None:
+                headers["Retry-After"] = str(self.config.retry_after)
+            self._send_json(self.config.fail_status, {"error": {"message": "injected failure"}}, headers)
+            return
+
+        admitted, self.limit_headers = self.config.admit()
+        if not admitted:
+            self._send_json(429, {"error": {"message": "rate limit exceeded"}})
+            return
+
+        reply = self.config.reply_for(payload.get("messages", []), payload.get("temperature"))
+        self.finish_reason = "stop"
+        if self.config.honor_max_tokens:
+            reply, self.finish_reason = self.config.truncate(reply, payload.get("messages", []),
+                                                             payload.get("max_tokens"))
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in payload.get("messages", []))
+        self.usage = {
+            "prompt_tokens": prompt_chars // 4 + 1,
+            "completion_tokens": len(reply) // 4 + 1,
+            "total_tokens": prompt_chars // 4 + len(reply) // 4 + 2
+        }
+        if payload.get("stream"):
+            self._send_stream(payload, reply)
+        else:
+            self._send_json(200, {
+                "id": "mock",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": self.finish_reason
+                }],
+                "usage": self.usage
+            })
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in {**getattr(self, "limit_headers", {}), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, payload, reply):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in self.limit_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        size = max(1, self.config.chunk_size)
+        for i in range(0, len(reply), size):
+            event = {
+                "id": "mock",
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "delta": {"content": reply[i:i + size]}, "finish_reason": None}]
+            }
+            self._write_chunk(f"data: {json.dumps(event)}\n\n")
+            time.sleep(self.config.chunk_delay)
+        final = {"id": "mock", "choices": [{"index": 0, "delta": {}, "finish_reason": self.finish_reason}],
+                 "usage": self.usage}
+        self._write_chunk(f"data: {json.dumps(final)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_server(host="127.0.0.1", port=0, config=None):
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Together chat-completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reply", default=DEFAULT_REPLY, help="Assistant reply to return")
+    parser.add_argument("--reply-size", type=int, help="Generate a reply of this many characters instead")
+    parser.add_argument("--think-ratio", type=float, default=0.5,
+                        help="Share of a generated reply inside a <think> block")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before responding")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between streamed chunks")
+    parser.add_argument("--chunk-size", type=int, default=4, help="Characters per streamed chunk")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Extra random delay up to this many seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--fail-status", type=int, default=503, help="HTTP status for injected failures")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with injected failures")
+    parser.add_argument("--fail-model", action="append", default=[], help="Model id that always fails")
+    parser.add_argument("--fail-first", type=int, default=0, help="Fail this many requests before any other rule")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SEC",
+                        help="Latency for one model id, overriding --latency")
+    parser.add_argument("--rpm", type=int, default=0,
+                        help="Requests per minute before answering 429, with x-ratelimit-* headers")
+    parser.add_argument("--temperature-reply", action="append", default=[], metavar="TEMP=REPLY",
+                        help="Reply with REPLY to requests sent at temperature TEMP")
+    parser.add_argument("--honor-max-tokens", action="store_true",
+                        help="Cut replies at max_tokens (finish_reason 'length') and resume them on continuation")
+    parser.add_argument("--route", action="append", default=[], metavar="TEXT=REPLY",
+                        help="Reply with REPLY when the last message contains TEXT")
+    args = parser.parse_args()
+
+    reply = make_reply(args.reply_size, args.think_ratio) if args.reply_size else args.reply
+    config = MockConfig(reply, args.latency, args.chunk_delay, args.chunk_size, args.latency_jitter,
+                        args.fail_rate, args.fail_status, args.retry_after, args.fail_model,
+                        dict(route.split("=", 1) for route in args.route),
+                        {model: float(seconds) for model, seconds in
+                         (entry.rsplit("=", 1) for entry in args.model_latency)}, args.rpm,
+                        {float(temperature): reply for temperature, reply in
+                         (entry.split("=", 1) for entry in args.temperature_reply)}, args.honor_max_tokens,
+                        args.fail_first)
+    server = make_server(args.host, args.port, config)
+    print(f"Mock server listening on http://{args.host}:{server.server_address[1]}/v1/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+import json
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from ai import (AUTO_MODEL, CLIA, MODELS, APIError, ChatJob, Conversation, ResponseCache, ThinkingFilter,
+                RunEngine, SharedRateLimiter, ThreadLocalStdout, WorkspaceIndex, daemon_request)
+from mock_server import DEFAULT_REPLY, MockConfig, make_server
+
+
+REPLY_TEXT = CLIA.clean_thinking_text(DEFAULT_REPLY)
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**options):
+        server = make_server(config=MockConfig(**options))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clients = []
+
+    def make(url, **attributes):
+        instance = CLIA()
+        instance.api_key = "test"
+        instance.api_url = url
+        instance.cache_mode = "off"
+        instance.backoff_base = 0.01
+        for name, value in attributes.items():
+            setattr(instance, name, value)
+        clients.append(instance)
+        return instance
+
+    yield make
+    for instance in clients:
+        instance.close()
+
+
+def split_randomly(text, rng):
+    if len(text) < 2:
+        return [text]
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 8))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_thinking_filter_is_independent_of_chunk_boundaries():
+    rng = random.Random(1234)
+    pieces = ["<think>", "</think>", "<thought>", "</thought>", "<THINK>", "</Think>", "<", ">", "a < b",
+              "<th", "</", "<b>", "text ", "\n", "x"]
+    for _ in range(500):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 25)))
+        expected = "".join(CLIA.clean_thinking_stream([text]))
+        assert "".join(CLIA.clean_thinking_stream(split_randomly(text, rng))) == expected, text
+
+
+def test_thinking_filter_matches_clean_text_for_balanced_blocks():
+    rng = random.Random(99)
+    for _ in range(200):
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            tag = rng.choice(["think", "thought"])
+            parts.append(rng.choice([f"<{tag}>reason {rng.random()}</{tag}>", f"answer <b>{rng.randint(0, 9)}</b> "]))
+        text = "".join(parts)
+        streamed = "".join(CLIA.clean_thinking_stream(split_randomly(text, rng)))
+        assert streamed.strip() == CLIA.clean_thinking_text(text)
+
+
+def test_thinking_filter_state_carries_across_streams():
+    thinking_filter = ThinkingFilter()
+    first = "".join(CLIA.clean_thinking_stream(["Intro <thi", "nk>secret"], thinking_filter=thinking_filter))
+    second = "".join(CLIA.clean_thinking_stream([" more secret</th", "ink> rest"], thinking_filter=thinking_filter))
+    assert first + second + thinking_filter.flush() == "Intro  rest"
+
+
+def test_retry_honors_retry_after_on_429(serve, client):
+    c = client(serve(fail_first=2, fail_status=429, retry_after=0.2), max_retries=3)
+    start = time.time()
+    raw, _, model = c._complete(MESSAGES, 64, 0.7, start, failover=False)
+    assert CLIA.clean_thinking_text(raw) == REPLY_TEXT
+    assert time.time() - start >= 0.4
+    assert c.http.stats()["requests"] == 3
+    assert c.dispatch_stats["retries"] == 2
+    assert c._breaker(model).state == "closed"
+
+
+def test_retry_recovers_from_5xx(serve, client):
+    c = client(serve(fail_first=1, fail_status=503), max_retries=2)
+    raw, _, model = c._complete(MESSAGES, 64, 0.7, time.time(), failover=False)
+    assert CLIA.clean_thinking_text(raw) == REPLY_TEXT
+    assert c.http.stats()["requests"] == 2
+    assert model == c.current_model
+
+
+def test_failover_answers_from_next_model(serve, client):
+    failing = MODELS[0][1]
+    c = client(serve(fail_models=[failing]), max_retries=0, current_model=failing)
+    raw, _, used_model = c._complete(MESSAGES, 64, 0.7, time.time())
+    assert used_model != failing
+    assert CLIA.clean_thinking_text(raw) == REPLY_TEXT
+    assert c.dispatch_stats["failovers"] == 1
+
+
+def test_breaker_opens_and_skips_failing_model(serve, client):
+    failing = MODELS[0][1]
+    c = client(serve(fail_models=[failing]), max_retries=0, failover=False, current_model=failing)
+    for _ in range(3):
+        with pytest.raises(APIError):
+            c._complete(MESSAGES, 64, 0.7, time.time())
+    assert c._breaker(failing).state == "open"
+    with pytest.raises(Exception, match="circuit breakers open"):
+        c._complete(MESSAGES, 64, 0.7, time.time())
+    assert c.http.stats()["requests"] == 3
+
+
+def test_auto_failover_stays_within_tier(serve, client):
+    c = client(serve(fail_models=["deepseek-ai/DeepSeek-R1-0528"]), max_retries=0, current_model=AUTO_MODEL,
+               tier=3)
+    with pytest.raises(APIError):
+        c._complete(MESSAGES, 64, 0.7, time.time())
+    assert c.http.stats()["requests"] == 1
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_truncated_reply_is_continued_and_stitched(serve, client, capsys, stream):
+    think = "".join(f"thought_{i} " for i in range(300))
+    code = "".join(f"print('line {i}')\n" for i in range(150))
+    reply = f"<think>{think}</think>\n\nHere is the code:\n```python\n{code}```\nDone."
+    c = client(serve(reply=reply, honor_max_tokens=True, chunk_size=7), stream=stream,
+               current_model="lgai/exaone-3-5-32b-instruct")
+    result = c.send_message("hi")
+    assert result == CLIA.clean_thinking_text(reply)
+    assert "thought_" not in capsys.readouterr().out
+    assert c.completion_stats["completed"] == 1
+    assert c.completion_stats["continuations"] >= 2
+
+
+def test_truncated_reply_is_not_cached(serve, client):
+    url = serve(reply="x" * 5000, honor_max_tokens=True)
+    c = client(url, cache_mode="on", max_continuations=0, current_model="lgai/exaone-3-5-32b-instruct")
+    c._drive_completion(MESSAGES, 256, 0.0, time.time(), stream=False)
+    c._drive_completion(MESSAGES, 256, 0.0, time.time(), stream=False)
+    assert c.http.stats()["requests"] == 2
+
+
+def test_cache_defaults_to_deterministic_requests(serve, client):
+    c = client(serve(), cache_mode="on")
+    for _ in range(2):
+        c.conversation.clear()
+        c.send_message("hello")
+    assert c.http.stats()["requests"] == 2
+    for _ in range(2):
+        c.conversation.clear()
+        c.respond("hello", cache=True)
+    assert c.http.stats()["requests"] == 3
+
+
+def test_validation_candidates_bypass_cache(serve, client):
+    url = serve(temperature_replies={0.2: "print(", 0.6: "x = (", 1.0: "def f(:"})
+    c = client(url, cache_mode="on")
+    for _ in range(2):
+        assert c.generate_validated("write a script", "a.py", 3, 2) is None
+    assert c.http.stats()["requests"] == 6
+    assert c.cache.hits == 0
+
+
+def test_compare_race_does_not_wait_for_losers(serve, client):
+    slow = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
+    c = client(serve(model_latency={slow: 3.0}))
+    start = time.time()
+    assert c.compare("hi", [MODELS[0][1], slow], "race") == REPLY_TEXT
+    assert time.time() - start < 2.0
+
+
+def test_interrupt_cancels_running_program(client):
+    c = client("http://127.0.0.1:9/v1/chat/completions")
+    with open(os.path.join(c.workspace, "spin.py"), "w") as f:
+        f.write("import time\nwhile True:\n    time.sleep(0.1)\n")
+    worker = threading.Thread(target=c._run_console_command, args=("run spin.py",))
+    worker.start()
+    deadline = time.time() + 5
+    while not (c._run_engine and c._run_engine.running) and time.time() < deadline:
+        time.sleep(0.05)
+    c._interrupt()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert c.run_engine.history[-1]["status"] == "cancelled"
+
+
+def test_reduce_notes_spans_all_notes(serve, client):
+    c = client(serve())
+    start, end, _ = c._reduce_notes("log", "q", [(500, 600, "b"), (1, 100, "a")], c.current_model)
+    assert (start, end) == (1, 600)
+
+
+def test_manifest_rejects_hidden_and_escaping_paths():
+    paths = [".clia/index.json", "a/.clia/router.json", ".env", "../x", "/etc/passwd", "a/../.clia/x",
+             "src/app.py", "src/app.py", "a/./b.py"]
+    manifest = CLIA.parse_manifest(json.dumps({"files": [{"path": path} for path in paths]}))
+    assert [entry["path"] for entry in manifest] == ["src/app.py", "a/b.py"]
+
+
+@pytest.mark.parametrize("prompt", ["validate this regex for me", "forked processes share memory?",
+                                    "compare these two approaches", "compact this paragraph please",
+                                    "attach the invoice to the email", "checkout flows that convert well"])
+def test_prompts_that_look_like_commands_reach_the_model(client, prompt):
+    c = client("http://127.0.0.1:9/v1/chat/completions")
+    assert c.handle_command(prompt) is False
+    assert c.validate_candidates == 0
+    assert c.conversation.branch == "main"
+
+
+def test_index_refresh_is_incremental_and_persists_on_save(tmp_path):
+    root = tmp_path / "workspace"
+    root.mkdir()
+    for number in range(5):
+        (root / f"module{number}.py").write_text(f"def handler_{number}(): return 'alpha beta'\n")
+    index_path = str(root / ".clia" / "index.json")
+    index = WorkspaceIndex(str(root), index_path)
+    assert index.refresh() == 5
+    assert not os.path.exists(index_path)
+    index.save()
+    with open(index_path) as f:
+        assert json.load(f)["format"] == WorkspaceIndex.FORMAT
+
+    (root / "module2.py").write_text("def rare_gamma(): return 1\n")
+    (root / "module4.py").unlink()
+    assert index.refresh() == 2
+    assert index.query("rare_gamma")[0][1][0] == "module2.py"
+    assert index.query("handler_4") == []
+    assert index.dirty
+    index.save()
+
+    reloaded = WorkspaceIndex(str(root), index_path)
+    assert reloaded.postings == index.postings
+    assert reloaded.files == index.files
+    assert reloaded.refresh() == 0
+    assert reloaded.query("rare_gamma") == index.query("rare_gamma")
+
+
+def test_index_ignores_unreadable_file(tmp_path):
+    index_path = tmp_path / "index.json"
+    index_path.write_text("cos\nsystem\n(S'echo'\ntR.")
+    index = WorkspaceIndex(str(tmp_path), str(index_path))
+    assert index.chunks == {}
+
+
+def test_batch_resumes_from_checkpoint_and_keeps_input_order(serve, client, tmp_path):
+    slow = MODELS[0][1]
+    c = client(serve(model_latency={slow: 0.3}))
+    input_path = tmp_path / "prompts.jsonl"
+    output_path = tmp_path / "results.jsonl"
+    jobs = [{"id": "a", "prompt": "one", "model": slow}, {"id": "b", "prompt": "two"},
+            {"id": "c", "prompt": "three", "model": 99}, {"id": "d", "prompt": "four"}]
+    input_path.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+    output_path.write_text(json.dumps({"id": "b", "response": "done", "error": None}) + "\n")
+
+    c.run_batch(str(input_path), str(output_path), concurrency=3, ordered=True)
+    records = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert [record["id"] for record in records] == ["b", "a", "c", "d"]
+    assert records[1]["response"] == REPLY_TEXT
+    assert "Invalid model number 99" in records[2]["error"]
+    assert c.http.stats()["requests"] == 2
+
+    c.run_batch(str(input_path), str(output_path), concurrency=3, ordered=True)
+    assert c.http.stats()["requests"] == 2
+    assert len(output_path.read_text().splitlines()) == 5
+
+
+def test_failover_reply_is_cached_under_the_answering_model(serve, client):
+    failing = MODELS[0][1]
+    c = client(serve(fail_models=[failing]), max_retries=0, cache_mode="on", current_model=failing)
+    _, _, used_model = c._complete(MESSAGES, 64, 0.0, time.time())
+    assert used_model != failing
+    assert c.http.stats()["requests"] == 2
+    c._complete(MESSAGES, 64, 0.0, time.time())
+    assert c.http.stats()["requests"] == 4
+    raw, _, model = c._complete(MESSAGES, 64, 0.0, time.time(), model=used_model)
+    assert (CLIA.clean_thinking_text(raw), model) == (REPLY_TEXT, used_model)
+    assert c.http.stats()["requests"] == 4
+
+
+def test_attach_notes_are_continued_past_the_token_limit(serve, client):
+    think = "".join(f"thought_{i} " for i in range(400))
+    reply = f"<think>{think}</think>Line 3 defines the handler."
+    c = client(serve(reply=reply, honor_max_tokens=True), current_model="lgai/exaone-3-5-32b-instruct")
+    assert c._map_chunk("log", "q", (1, 10, "text", 4), c.current_model) == (1, 10, "Line 3 defines the handler.")
+    assert c.completion_stats["continuations"] >= 1
+
+
+def test_unclosed_thinking_is_dropped():
+    assert CLIA.clean_thinking_text("Answer <think>half a thought") == "Answer"
+    assert CLIA.clean_thinking_text("<thought>a</thought>B<think>c") == "B"
+
+
+def test_project_plan_survives_a_truncated_manifest(serve, client):
+    files = [{"path": f"pkg/module_{i}.py", "description": f"module number {i} of the package"} for i in range(120)]
+    c = client(serve(reply=json.dumps({"files": files}), honor_max_tokens=True),
+               current_model="lgai/exaone-3-5-32b-instruct")
+    assert [entry["path"] for entry in c.plan_project("a package")] == [entry["path"] for entry in files]
+    assert c.completion_stats["continuations"] >= 1
+
+
+def test_conversation_tree_round_trips_branches():
+    conversation = Conversation([{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+    conversation.fork("side")
+    conversation.append({"role": "user", "content": "c"})
+    conversation.checkout("main")
+    conversation.append({"role": "user", "content": "d"})
+    conversation.fork()
+    conversation.undo()
+
+    restored = Conversation.from_tree(json.loads(json.dumps(conversation.to_tree())))
+    assert restored.branch == conversation.branch
+    assert list(restored) == list(conversation)
+    for name in conversation.branches:
+        restored.checkout(name)
+        conversation.checkout(name)
+        assert list(restored) == list(conversation)
+        assert restored.shared_depth("main") == conversation.shared_depth("main")
+    assert len(restored.to_tree()["nodes"]) == 4
+
+
+def test_branch_commands_wait_for_running_prompts(client, capsys):
+    c = client("http://127.0.0.1:9/v1/chat/completions")
+    c.conversation.append({"role": "user", "content": "a"})
+    job = ChatJob(1, "question")
+    job.started = time.time()
+    c.jobs[job.id] = job
+    for command in ("fork side", "undo", "checkout main", "clear"):
+        c.handle_command(command)
+    assert (c.conversation.branch, len(c.conversation), list(c.conversation.branches)) == ("main", 1, ["main"])
+    assert capsys.readouterr().out.count("Cannot") == 4
+    c.jobs.clear()
+    c.handle_command("fork side")
+    assert c.conversation.branch == "side"
+
+
+def test_response_cache_shares_one_index_between_processes(tmp_path):
+    first = ResponseCache(str(tmp_path), max_bytes=100)
+    second = ResponseCache(str(tmp_path), max_bytes=100)
+    first.put("a" * 64, "x" * 40)
+    second.put("b" * 64, "y" * 40)
+    assert second.get("a" * 64) == "x" * 40
+    assert sorted(ResponseCache(str(tmp_path)).index) == ["a" * 64, "b" * 64]
+
+    index_mtime = os.stat(tmp_path / "index.json").st_mtime_ns
+    assert first.get("b" * 64) == "y" * 40
+    assert os.stat(tmp_path / "index.json").st_mtime_ns == index_mtime
+    first.flush()
+
+    orphan = tmp_path / f"{'c' * 64}.txt"
+    orphan.write_text("lost")
+    os.utime(orphan, (0, 0))
+    second.put("d" * 64, "z" * 40)
+    assert not orphan.exists()
+    assert sorted(ResponseCache(str(tmp_path)).index) == ["b" * 64, "d" * 64]
+    assert sorted(path.name for path in tmp_path.glob("*.txt")) == [f"{'b' * 64}.txt", f"{'d' * 64}.txt"]
+
+
+def test_daemon_protocol_serves_one_off_and_named_sessions(serve, client, monkeypatch, capsys):
+    c = client(serve())
+    c.daemon_started = c.session_start
+    socket_path = os.path.join(tempfile.mkdtemp(), "clia.sock")
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            c._handle_client(self.rfile, self.wfile)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(sys, "stdout", ThreadLocalStdout(sys.stdout))
+    try:
+        assert daemon_request(socket_path, {"op": "ping"}) == {"type": "result", "text": "pong"}
+        for request in ({"prompt": "hi"}, {"prompt": "hi", "model": 2}, {"prompt": "hi", "session": "s"},
+                        {"prompt": "again", "session": "s"}):
+            reply = daemon_request(socket_path, dict(request, op="prompt"))
+            assert (reply["type"], reply["text"]) == ("result", REPLY_TEXT)
+        assert daemon_request(socket_path, {"op": "nope"})["type"] == "error"
+        capsys.readouterr()
+        assert daemon_request(socket_path, {"op": "stats"})["type"] == "result"
+    finally:
+        server.shutdown()
+        server.server_close()
+        sys.stdout.default.flush()
+
+    session, _ = c.daemon_sessions["s"]
+    assert (session.message_count, len(session.conversation)) == (2, 4)
+    assert c.message_count == 0 and len(c.conversation) == 0
+    out = capsys.readouterr().out
+    assert "Client requests: 7 (4 prompt, 1 ping, 1 nope, 1 stats)" in out
+    assert f"{c.get_current_model_name()}: 3 messages" in out
+    assert f"{MODELS[1][0]}: 1 messages" in out
+
+
+def test_conversation_window_drops_oldest_turns_first():
+    messages = [{"role": "system", "content": "rules " * 10}]
+    messages += [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " * 10} for i in range(10)]
+    conversation = Conversation(messages)
+    pending = [{"role": "user", "content": "new question"}]
+    every = messages + pending
+    full = sum(Conversation.estimate_tokens(message) for message in every)
+
+    assert conversation.window(full, pending=pending) == (every, full, 0)
+
+    selected, tokens, dropped = conversation.window(full - 100, pending=pending)
+    assert selected == [messages[0]] + every[-(len(selected) - 1):]
+    assert tokens == sum(Conversation.estimate_tokens(message) for message in selected) <= full - 100
+    assert dropped == len(every) - len(selected) and len(selected) >= 5
+
+    selected, tokens, dropped = conversation.window(1, pending=pending)
+    assert selected == [messages[0], pending[0]]
+    assert dropped == len(every) - 2
+
+
+def test_session_journal_resumes_and_compacts(serve, client):
+    url = serve()
+    c = client(url)
+    c.start_session("s")
+    c.send_message("one")
+    c.branch_conversation("fork", "side")
+    c.send_message("two")
+    c.branch_conversation("checkout", "main")
+    c.send_message("three")
+    c.close()
+
+    resumed = client(url)
+    assert resumed.resume_session("s")
+    assert (resumed.conversation.to_tree(), resumed.message_count) == (c.conversation.to_tree(), 3)
+    assert resumed.model_usage == c.model_usage
+
+    compactor = client(url)
+    compactor.compact_session("s")
+    with open(resumed.journal.path) as f:
+        assert [json.loads(line)["type"] for line in f] == ["snapshot"]
+    again = client(url)
+    assert again.resume_session("s")
+    assert (again.conversation.to_tree(), again.message_count) == (c.conversation.to_tree(), 3)
+
+    again.clear_conversation()
+    again.send_message("four")
+    again.close()
+    assert again.journal._read_index()["base"] > 0
+    last = client(url)
+    assert last.resume_session("s")
+    assert [message["content"] for message in last.conversation][0] == "four"
+    assert (len(last.conversation), last.message_count) == (2, 4)
+
+
+def test_run_engine_enforces_timeout_and_memory_limit(tmp_path, capsys):
+    spin = tmp_path / "spin.py"
+    spin.write_text("while True:\n    pass\n")
+    hog = tmp_path / "hog.py"
+    hog.write_text("data = bytearray(512 * 1024 * 1024)\n")
+    hello = tmp_path / "hello.py"
+    hello.write_text("print('hello')\n")
+    engine = RunEngine(workers=1, timeout=0.5, memory_limit_mb=128)
+    try:
+        engine.warm()
+        record = engine.run(str(hello))
+        assert (record["status"], record["exit_code"], record["warm"]) == ("ok", 0, True)
+        assert capsys.readouterr().out == "hello\n"
+
+        record = engine.run(str(spin), echo=False)
+        assert record["status"] == "timeout"
+        assert record["duration"] < 3
+
+        record = engine.run(str(hog), echo=False)
+        assert record["status"] == "error"
+        assert "MemoryError" in record["stderr_tail"]
+        assert [entry["status"] for entry in engine.history] == ["ok", "timeout", "error"]
+    finally:
+        engine.shutdown()
+
+
+def test_metrics_are_recorded_per_request_and_exported(serve, client, tmp_path):
+    url = serve(fail_first=1, fail_status=503)
+    jsonl_path = tmp_path / "metrics.jsonl"
+    c = client(url, max_retries=1)
+    c.metrics.path = str(jsonl_path)
+    c._complete(MESSAGES, 64, 0.7, time.time(), failover=False)
+    records = [json.loads(line) for line in jsonl_path.read_text().splitlines()]
+    assert [record["status"] for record in records] == [503, 200]
+    assert all(record["model"] == c.current_model and record["request_bytes"] > 0 for record in records)
+    assert records[1]["response_bytes"] > 0 and records[1]["ttfb"] <= records[1]["total"]
+
+    prom_path = tmp_path / "metrics.prom"
+    c.metrics.path = str(prom_path)
+    c.close()
+    lines = prom_path.read_text().splitlines()
+    model = c.current_model
+    assert f'clia_requests_total{{model="{model}",status="503"}} 1' in lines
+    assert f'clia_requests_total{{model="{model}",status="200"}} 1' in lines
+    assert f'clia_request_duration_seconds_bucket{{model="{model}",le="+Inf"}} 2' in lines
+    assert f'clia_request_duration_seconds_count{{model="{model}"}} 2' in lines
+    buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if line.startswith("clia_request_duration_seconds_bucket")]
+    assert buckets == sorted(buckets)
+    assert c.metrics.summary()[model][0] == 2
+
+
+def test_shared_rate_limiter_learns_headers_and_queues_across_processes(tmp_path):
+    path = str(tmp_path / "limits.json")
+    first = SharedRateLimiter(path)
+    second = SharedRateLimiter(path)
+    assert SharedRateLimiter.parse_reset("1m30s") == 90 and SharedRateLimiter.parse_reset("250ms") == 0.25
+
+    first.acquire(100)
+    first.settle({"X-RateLimit-Limit-Requests": "120", "X-RateLimit-Remaining-Requests": "0",
+                  "X-RateLimit-Reset-Requests": "0.3s", "X-RateLimit-Limit-Tokens": "6000",
+                  "X-RateLimit-Remaining-Tokens": "5000"}, 100, used=40)
+    assert first.describe() == "120 requests/min (learned), 6000 tokens/min (learned)"
+    with open(path) as f:
+        state = json.load(f)
+    assert state["inflight"] == [] and state["tokens"] == 5060
+
+    start = time.monotonic()
+    second.acquire(10)
+    assert time.monotonic() - start >= 0.25
+    assert second.waits == 1
+    assert second.describe() == first.describe()
+
+    second.settle({}, 10, retry_after=0.3)
+    start = time.monotonic()
+    first.acquire(10)
+    assert time.monotonic() - start >= 0.25 and first.waits == 1